@@ -0,0 +1,663 @@
+"""Offline benchmarks for the bot.
+
+Runs the bot's handlers against a fake Bot API, so no token or network access is needed.
+
+    python benchmark.py startup
+    python benchmark.py ratelimit
+    python benchmark.py records
+    python benchmark.py prices
+    python benchmark.py journal
+    python benchmark.py hotpaths --save      # record benchmark_baseline.json
+    python benchmark.py hotpaths --compare   # fail on regressions against it
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+from telegram import Update
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+import bot
+
+FAKE_TOKEN = "123456:BENCHMARK"
+BENCH_USER_ID = 4242
+
+
+# --- Fake Bot API ---
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers Bot API calls locally with minimal valid payloads."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = []
+        self._next_message_id = 1000
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, params: dict, media_type: str | None = None) -> dict:
+        self._next_message_id += 1
+        chat_id = params.get("chat_id", BENCH_USER_ID)
+        message = {
+            "message_id": self._next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else BENCH_USER_ID, "type": "private"},
+            "text": params.get("text", ""),
+        }
+        file = {"file_id": f"file{self._next_message_id}", "file_unique_id": f"unique{self._next_message_id}"}
+        if media_type == "photo": message["photo"] = [{**file, "width": 1, "height": 1}]
+        elif media_type == "video": message["video"] = {**file, "width": 1, "height": 1, "duration": 1}
+        return message
+
+    def result_for(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot", "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if endpoint == "sendMediaGroup":
+            return [self._message(params, item.get("type")) for item in params.get("media", [])]
+        if endpoint == "editMessageMedia":
+            return self._message(params, params.get("media", {}).get("type"))
+        if endpoint in ("sendPhoto", "sendVideo"):
+            return self._message(params, endpoint[4:].lower())
+        if endpoint.startswith(("send", "edit", "copy", "forward")):
+            return self._message(params)
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, params))
+        if self.latency: await asyncio.sleep(self.latency)
+        # Telegram rejects media groups outside 2-10 items, and PTB does not check before sending
+        if endpoint == "sendMediaGroup" and not 2 <= len(params.get("media", [])) <= 10:
+            return 400, json.dumps({"ok": False, "error_code": 400, "description": "Bad Request: media group must contain 2-10 items"}).encode()
+        return 200, json.dumps({"ok": True, "result": self.result_for(endpoint, params)}).encode()
+
+
+class FloodEnforcingRequest(FakeTelegramRequest):
+    """Fake Bot API that answers with 429 like Telegram once its flood limits are exceeded.
+
+    All limits are multiplied by ``scale`` so a simulation finishes in seconds instead of minutes.
+    """
+
+    def __init__(self, scale: float = 1.0, latency: float = 0.0):
+        super().__init__(latency=latency)
+        self.scale = scale
+        self.flood_errors = 0
+        self._buckets = {}
+
+    def _take(self, key, rate: float, capacity: float) -> float:
+        """Consumes a token, or returns how many seconds are missing until one is available."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now); return (1 - tokens) / rate
+        self._buckets[key] = (tokens - 1, now); return 0.0
+
+    def _flood_wait(self, endpoint: str, params: dict) -> float:
+        chat_id = params.get("chat_id")
+        if chat_id is None: return 0.0
+        is_group = str(chat_id).startswith("-")
+        # Like Telegram, group limits apply to new messages, not to edits
+        if endpoint.startswith(bot.MESSAGE_ENDPOINT_PREFIXES) and not (is_group and endpoint.startswith("edit")):
+            rate, capacity = (bot.GROUP_RATE_PER_SECOND, bot.GROUP_BURST) if is_group else (bot.CHAT_RATE_PER_SECOND, bot.CHAT_BURST)
+            wait = self._take(("chat", str(chat_id)), rate * self.scale, capacity)
+            if wait: return wait
+        return self._take("overall", bot.OVERALL_RATE_PER_SECOND * self.scale, bot.OVERALL_RATE_PER_SECOND * self.scale)
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        wait = self._flood_wait(endpoint, request_data.parameters if request_data else {})
+        if wait:
+            self.flood_errors += 1
+            retry_after = max(1, math.ceil(wait))
+            return 429, json.dumps({"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}", "parameters": {"retry_after": retry_after}}).encode()
+        return await super().do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+
+
+def make_command_update(application, text: str = "/start", user_id: int = BENCH_USER_ID, update_id: int = 1) -> Update:
+    command = text.split()[0]
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}] if text.startswith("/") else [],
+        },
+    }, application.bot)
+
+
+def make_callback_update(application, data: str, user_id: int = BENCH_USER_ID, update_id: int = 1) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "chat_instance": "bench", "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": "bench"},
+        },
+    }, application.bot)
+
+
+def use_temp_data_files(directory: str):
+    """Points the bot's data files at a scratch directory so benchmarks never touch real data."""
+    bot.STATS_FILE = os.path.join(directory, "stats.json")
+    bot.VOUCHER_FILE = os.path.join(directory, "vouchers.json")
+    bot.MEDIA_CACHE_FILE = os.path.join(directory, "media_cache.json")
+    bot.STATS_ARCHIVE_FILE = os.path.join(directory, "stats_archive.jsonl")
+
+
+def report(name: str, samples: list, unit: str = "ms", scale: float = 1000.0) -> dict:
+    result = {"median": statistics.median(samples) * scale, "min": min(samples) * scale, "max": max(samples) * scale, "runs": len(samples)}
+    print(f"{name:<40} median {result['median']:9.2f} {unit}   min {result['min']:9.2f}   max {result['max']:9.2f}")
+    return result
+
+
+# --- Startup ---
+
+IMPORT_SNIPPET = "import sys, time; t = time.perf_counter(); import bot; print(time.perf_counter() - t, 'fpdf' in sys.modules)"
+
+def bench_import(runs: int) -> dict:
+    samples = []; fpdf_loaded = False
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        samples.append(float(out[0])); fpdf_loaded = fpdf_loaded or out[1] == "True"
+    result = report("import bot", samples)
+    result["fpdf_loaded_at_import"] = fpdf_loaded
+    print(f"{'fpdf loaded at import':<40} {fpdf_loaded}")
+    return result
+
+
+def bench_build(runs: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        t = time.perf_counter(); bot.build_application(FAKE_TOKEN, request=FakeTelegramRequest()); samples.append(time.perf_counter() - t)
+    return report("build_application", samples)
+
+
+async def _first_update_latency(latency: float) -> tuple:
+    request = FakeTelegramRequest(latency=latency)
+    application = bot.build_application(FAKE_TOKEN, request=request)
+    t0 = time.perf_counter()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    ready = time.perf_counter() - t0
+    await application.process_update(make_command_update(application))
+    first_update = time.perf_counter() - t0
+    await application.stop(); await application.shutdown()
+    return ready, first_update
+
+
+def bench_first_update(runs: int, latency: float) -> dict:
+    ready_samples = []; first_samples = []
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_data_files(tmp)
+        for _ in range(runs):
+            bot.STATS_STORE.close()
+            for path in (bot.STATS_FILE, bot.STATS_FILE + ".journal", bot.VOUCHER_FILE):
+                if os.path.exists(path): os.remove(path)
+            ready, first = asyncio.run(_first_update_latency(latency))
+            ready_samples.append(ready); first_samples.append(first)
+    return {"ready": report("initialize + post_init + start", ready_samples), "first_update": report("ready + first /start processed", first_samples)}
+
+
+def run_startup(args) -> dict:
+    print(f"Startup benchmark (fake API latency {args.latency * 1000:.0f} ms)")
+    return {"import": bench_import(args.runs), "build": bench_build(args.runs), "first_update": bench_first_update(args.runs, args.latency)}
+
+
+# --- Rate limiting ---
+
+ADMIN_GROUP_ID = -1001234567890
+
+async def _simulate_burst(args, limited: bool) -> dict:
+    """Fires a burst of user replies, admin log edits and cleanup deletes at once, like a traffic spike."""
+    request = FloodEnforcingRequest(scale=args.scale)
+    limiter = scaled_limiter(args.scale) if limited else None
+    fake_bot = ExtBot(FAKE_TOKEN, request=request, get_updates_request=FakeTelegramRequest(), rate_limiter=limiter)
+    await fake_bot.initialize()
+    lanes = {"user replies": [], "admin logs": [], "cleanup deletes": []}; failures = 0
+    t0 = time.perf_counter()
+
+    async def timed(lane: str, call):
+        nonlocal failures
+        try: await call; lanes[lane].append(time.perf_counter() - t0)
+        except Exception: failures += 1
+
+    calls = []
+    for i in range(args.users):
+        chat_id = 10_000 + i
+        calls += [timed("user replies", fake_bot.send_message(chat_id, "reply")) for _ in range(args.replies)]
+        calls += [timed("cleanup deletes", fake_bot.delete_message(chat_id, 1)) for _ in range(args.deletes)]
+        if i % args.admin_every == 0:
+            rl = {"rate_limit_args": bot.PRIORITY_ADMIN_LOG} if limited else {}
+            calls.append(timed("admin logs", fake_bot.edit_message_text("log", chat_id=ADMIN_GROUP_ID, message_id=1, **rl)))
+    await asyncio.gather(*calls)
+    await fake_bot.shutdown()
+    result = {"flood_errors": request.flood_errors, "failed_calls": failures, "total_seconds": time.perf_counter() - t0}
+    for lane, samples in lanes.items():
+        if samples: result[lane] = {"completed": len(samples), "p50_ms": statistics.median(samples) * 1000, "max_ms": max(samples) * 1000}
+    return result
+
+
+def scaled_limiter(scale: float) -> bot.PriorityRateLimiter:
+    return bot.PriorityRateLimiter(overall_rate=bot.OVERALL_RATE_PER_SECOND * scale, chat_rate=bot.CHAT_RATE_PER_SECOND * scale, chat_burst=bot.CHAT_BURST,
+                                   group_rate=bot.GROUP_RATE_PER_SECOND * scale, group_burst=bot.GROUP_BURST)
+
+
+async def _simulate_handlers(args) -> dict:
+    """Runs real updates through the handlers with admin logging on, so admin log posts compete with replies."""
+    request = FloodEnforcingRequest(scale=args.scale)
+    application = bot.build_application(FAKE_TOKEN, request=request, rate_limiter=scaled_limiter(args.scale))
+    await application.initialize(); await application.start()
+    latencies = {}; update_id = 0; t0 = time.perf_counter()
+    for i in range(args.users):
+        user_id = 10_000 + i
+        for kind, make in (("/start", lambda: make_command_update(application, "/start", user_id, update_id)),
+                           ("select_lang", lambda: make_callback_update(application, "select_lang:de", user_id, update_id)),
+                           ("show_price_options", lambda: make_callback_update(application, "show_price_options", user_id, update_id))):
+            update_id += 1; t = time.perf_counter()
+            await application.process_update(make())
+            latencies.setdefault(kind, []).append(time.perf_counter() - t)
+    handled = time.perf_counter() - t0
+    await application.stop(); await application.shutdown()  # Waits for the queued admin log posts
+    result = {"flood_errors": request.flood_errors, "handled_seconds": handled, "drained_seconds": time.perf_counter() - t0,
+              "admin_log_calls": sum(1 for endpoint, params in request.calls if str(params.get("chat_id")) == str(ADMIN_GROUP_ID))}
+    for kind, samples in latencies.items():
+        result[kind] = {"p50_ms": statistics.median(samples) * 1000, "max_ms": max(samples) * 1000}
+    return result
+
+
+def run_handler_scenario(args) -> dict:
+    original = bot.NOTIFICATION_GROUP_ID; bot.NOTIFICATION_GROUP_ID = str(ADMIN_GROUP_ID)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            use_temp_data_files(tmp); result = asyncio.run(_simulate_handlers(args)); bot.STATS_STORE.close()
+    finally: bot.NOTIFICATION_GROUP_ID = original
+    print(f"\nhandlers with admin logging: {args.users} users, {result['flood_errors']} flood errors, {result['admin_log_calls']} admin log calls, "
+          f"updates handled in {result['handled_seconds']:.2f}s, admin logs drained after {result['drained_seconds']:.2f}s")
+    for kind in ("/start", "select_lang", "show_price_options"):
+        print(f"  {kind:<18} p50 {result[kind]['p50_ms']:9.1f} ms   max {result[kind]['max_ms']:9.1f} ms")
+    return result
+
+
+def run_ratelimit(args) -> dict:
+    print(f"Burst simulation: {args.users} users, limits scaled x{args.scale}")
+    results = {}
+    for name, limited in (("without limiter", False), ("with PriorityRateLimiter", True)):
+        result = results[name] = asyncio.run(_simulate_burst(args, limited))
+        print(f"\n{name}: {result['flood_errors']} flood errors (429), {result['failed_calls']} failed calls, {result['total_seconds']:.2f}s total")
+        for lane in ("user replies", "admin logs", "cleanup deletes"):
+            if lane in result: print(f"  {lane:<18} {result[lane]['completed']:5d} done   p50 {result[lane]['p50_ms']:9.1f} ms   max {result[lane]['max_ms']:9.1f} ms")
+    results["handlers"] = run_handler_scenario(args)
+    limited, handlers = results["with PriorityRateLimiter"], results["handlers"]; problems = []
+    if limited["flood_errors"] or limited["failed_calls"]: problems.append(f"{limited['flood_errors']} flood errors and {limited['failed_calls']} failed calls with the limiter")
+    # Lane order only means something once the burst is larger than the overall limit lets through at once
+    if args.users * (args.replies + args.deletes) > bot.OVERALL_RATE_PER_SECOND * args.scale:
+        for lane in ("admin logs", "cleanup deletes"):
+            if lane in limited and limited[lane]["max_ms"] < limited["user replies"]["max_ms"]: problems.append(f"{lane} finished before the user replies")
+    if handlers["flood_errors"]: problems.append(f"{handlers['flood_errors']} flood errors in the handler scenario")
+    if handlers["show_price_options"]["max_ms"] > 1000: problems.append("show_price_options waited more than 1 s for its reply")
+    if problems: sys.exit("Rate limiting check failed: " + "; ".join(problems))
+    return results
+
+
+# --- User records ---
+
+def legacy_user(i: int) -> dict:
+    now = datetime.now().isoformat()
+    return {"first_start": now, "last_start": now, "discount_sent": i % 3 == 0, "preview_clicks": i % 26,
+            "payments_initiated": ["PayPal (10 Bilder): 5€"] if i % 5 == 0 else [], "banned": False, "paypal_offer_sent": i % 2 == 0}
+
+
+def _measure(name: str, build) -> tuple:
+    tracemalloc.start()
+    t = time.perf_counter(); users = build(); elapsed = time.perf_counter() - t
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    per_user = size / len(users)
+    print(f"{name:<28} {per_user:8.1f} bytes/user   built in {elapsed:6.2f}s")
+    return users, per_user
+
+
+def run_records(args) -> dict:
+    print(f"Per-user memory and serialization at {args.users:,} users")
+    legacy, legacy_bytes = _measure("legacy dict", lambda: {str(i): legacy_user(i) for i in range(args.users)})
+    records, record_bytes = _measure("UserRecord", lambda: {user_id: bot.UserRecord.from_json(data) for user_id, data in legacy.items()})
+    results = {"users": args.users, "legacy_bytes_per_user": legacy_bytes, "record_bytes_per_user": record_bytes}
+    for name, users, default in (("legacy", legacy, None), ("record", records, bot.encode_stats_object)):
+        t = time.perf_counter(); blob = json.dumps({"users": users}, indent=4, default=default); dump = time.perf_counter() - t
+        t = time.perf_counter(); loaded = json.loads(blob); load = time.perf_counter() - t
+        if name == "record":
+            t = time.perf_counter(); {user_id: bot.UserRecord.from_json(data) for user_id, data in loaded["users"].items()}; load += time.perf_counter() - t
+        results[name] = {"bytes": len(blob), "dump_seconds": dump, "load_seconds": load}
+        print(f"{name + ' json':<28} {len(blob) / 1e6:8.1f} MB   dump {dump:6.2f}s   load {load:6.2f}s")
+    return results
+
+
+# --- Prices ---
+
+def legacy_price(media_type: str, amount: int, discount_data) -> tuple:
+    """Price logic as the handlers computed it before the price matrix: (shown base, paid price, discounted)."""
+    base_price = bot.PRICES[media_type][amount]
+    if media_type == "livecall": return base_price, base_price, False
+    if media_type == "treffen": return base_price, math.ceil(base_price / 4), False
+    discount_price = bot.get_discounted_price(base_price, discount_data, f"{media_type}_{amount}")
+    return (base_price, base_price, False) if discount_price == -1 else (base_price, discount_price, True)
+
+
+def random_discount_profile(rng: random.Random):
+    packages = [f"{media_type}_{amount}" for media_type in ("bilder", "videos") for amount in bot.PRICES[media_type]]
+    kind = rng.choice([None, "percent", "euro_packages", "percent_packages", "unknown"])
+    if kind is None: return rng.choice([None, {}])
+    if kind == "percent": return {"type": kind, "value": rng.choice([0, 5, 10, 33, 50, 99, 100, rng.uniform(0, 100)])}
+    chosen = rng.sample(packages, rng.randint(0, len(packages)))
+    upper = 60 if kind == "euro_packages" else 100
+    return {"type": kind, "packages": {key: rng.randint(0, upper) for key in chosen}}
+
+
+def run_prices(args) -> dict:
+    rng = random.Random(args.seed); mismatches = 0
+    profiles = [random_discount_profile(rng) for _ in range(args.profiles)]
+    for profile in profiles:
+        for media_type, prices in bot.PRICES.items():
+            for amount in prices:
+                entry = bot.get_package_price(media_type, amount, profile)
+                if (entry.base, entry.price, entry.discounted) != legacy_price(media_type, amount, profile):
+                    mismatches += 1; print(f"MISMATCH {media_type} {amount} {profile}: {entry} != {legacy_price(media_type, amount, profile)}")
+    print(f"Property check: {args.profiles} random discount profiles, {mismatches} mismatches")
+    packages = [(media_type, amount) for media_type in ("bilder", "videos") for amount in (10, 25, 35)]
+    renders = [rng.choice(profiles[:20]) for _ in range(args.renders)]
+    t = time.perf_counter()
+    for profile in renders:
+        for media_type, amount in packages: legacy_price(media_type, amount, profile)
+    legacy = (time.perf_counter() - t) / args.renders
+    t = time.perf_counter()
+    for profile in renders:
+        matrix = bot.get_price_matrix(profile)
+        for package in packages: matrix[package]
+    compiled = (time.perf_counter() - t) / args.renders
+    print(f"price keyboard ({len(packages)} packages, {args.renders:,} renders): legacy {legacy * 1e6:.2f} us   matrix {compiled * 1e6:.2f} us")
+    if mismatches: sys.exit(f"{mismatches} price matrix entries differ from the legacy calculation")
+    return {"mismatches": mismatches, "legacy_us_per_render": legacy * 1e6, "matrix_us_per_render": compiled * 1e6}
+
+
+# --- Journal ---
+
+def seed_stats(users: int) -> dict:
+    stats = bot.empty_stats()
+    stats["users"] = {str(i): bot.UserRecord.new() for i in range(users)}
+    return stats
+
+
+def legacy_save_stats(stats: dict):
+    """The previous save_stats: rewrite the whole file in place on every mutation."""
+    with open(bot.STATS_FILE, "w") as f: json.dump(stats, f, indent=4, default=bot.encode_stats_object)
+
+
+def bench_mutation_cost(args) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_data_files(tmp)
+        bot.save_stats(seed_stats(args.users)); stats = bot.load_stats()
+        for name, save in (("full rewrite", legacy_save_stats), ("journal", lambda s, user_id: bot.save_stats(s, users=[user_id]))):
+            t = time.perf_counter()
+            for i in range(args.mutations):
+                user_id = str(i % args.users); stats["users"][user_id].preview_clicks += 1
+                save(stats) if name == "full rewrite" else save(stats, user_id)
+            bot.STATS_STORE.journal.sync()
+            results[name] = (time.perf_counter() - t) / args.mutations * 1e6
+            print(f"{name:<14} {results[name]:10.1f} us per mutation ({args.users:,} users)")
+        bot.STATS_STORE.close()
+    return results
+
+
+def journal_child(directory: str, users: int, checkpoint_every: int, crash_in_checkpoint: str):
+    """Mutates stats forever, acknowledging each committed mutation on stdout, until it is killed."""
+    use_temp_data_files(directory)
+    if crash_in_checkpoint == "background":
+        asyncio.run(mutate_with_background_checkpoints(users, checkpoint_every)); return
+    if crash_in_checkpoint:
+        original_replace, original_reset = os.replace, bot.StatsJournal.reset
+        if crash_in_checkpoint == "before_replace": bot.os.replace = lambda *a: os._exit(1)
+        else: bot.StatsJournal.reset = lambda self: os._exit(1) if self.size else original_reset(self)
+    stats = bot.load_stats(); i = stats.get("mutations", 0)
+    while True:
+        user_id = str(i % users); stats["users"][user_id].preview_clicks += 1; i += 1; stats["mutations"] = i
+        bot.save_stats(stats, users=[user_id], keys=["mutations"])
+        print(i, flush=True)
+        if i % checkpoint_every == 0: bot.save_stats(stats)
+
+
+async def mutate_with_background_checkpoints(users: int, checkpoint_every: int):
+    """Like journal_child, but checkpoints run in the background while mutations go on, as in the bot."""
+    stats = bot.load_stats(); i = stats.get("mutations", 0)
+    while True:
+        user_id = str(i % users); stats["users"][user_id].preview_clicks += 1; i += 1; stats["mutations"] = i
+        bot.save_stats(stats, users=[user_id], keys=["mutations"])
+        print(i, flush=True)
+        if i % checkpoint_every == 0: asyncio.create_task(bot.STATS_STORE.checkpoint_in_background())
+        await asyncio.sleep(0.001)
+
+
+def expected_clicks(mutations: int, users: int) -> dict:
+    return {str(j): mutations // users + (1 if j < mutations % users else 0) for j in range(users)}
+
+
+def run_crash_injection(args) -> dict:
+    rng = random.Random(args.seed); failures = 0; torn = 0
+    modes = ["kill", "kill", "before_replace", "before_journal_reset", "torn_tail", "background"]
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_data_files(tmp)
+        bot.save_stats(seed_stats(args.crash_users)); bot.STATS_STORE.close()
+        for round_no in range(args.crashes):
+            mode = rng.choice(modes)
+            child = subprocess.Popen([sys.executable, __file__, "journal", "--child", tmp, "--users", str(args.crash_users), "--checkpoint-every", str(rng.randint(5, 60)),
+                                      "--crash-in-checkpoint", mode if mode.startswith("before") or mode == "background" else ""], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            acked = None; target = rng.randint(1, 200)
+            for n, line in enumerate(child.stdout):
+                acked = int(line)
+                if mode in ("kill", "torn_tail", "background") and n >= target: child.send_signal(signal.SIGKILL); break
+            child.wait(); child.stdout.close()
+            journal_path = bot.STATS_FILE + ".journal"
+            if mode == "torn_tail" and os.path.getsize(journal_path) > 0:
+                size = os.path.getsize(journal_path)
+                with open(journal_path, "r+b") as f: f.truncate(size - rng.randint(1, min(size, 40)))
+                torn += 1
+            bot.STATS_STORE.recover(); stats = bot.load_stats()
+            mutations = stats.get("mutations", 0)
+            clicks = {user_id: record.preview_clicks for user_id, record in stats["users"].items()}
+            consistent = clicks == expected_clicks(mutations, args.crash_users)
+            # Every acknowledged mutation must survive, except the one torn on purpose
+            durable = acked is None or mutations >= acked - (1 if mode == "torn_tail" else 0)
+            if not (consistent and durable):
+                failures += 1; print(f"round {round_no} ({mode}): acked {acked}, recovered {mutations}, consistent {consistent}")
+            bot.STATS_STORE.close()
+    print(f"Crash injection: {args.crashes} crashes ({torn} with torn journal tails), {failures} failures")
+    if failures: sys.exit(f"{failures} crash injection round(s) lost acknowledged changes or recovered inconsistently")
+    return {"crashes": args.crashes, "failures": failures}
+
+
+def run_journal(args) -> dict:
+    if args.child:
+        journal_child(args.child, args.users, args.checkpoint_every, args.crash_in_checkpoint); return {}
+    return {"cost": bench_mutation_cost(args), "crash_injection": run_crash_injection(args)}
+
+
+# --- Hot paths ---
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def measure(func, rounds: int = 7, round_time: float = 0.05) -> dict:
+    """Times func pytest-benchmark style: iterations per round are calibrated to last about round_time,
+    and the statistics are per call, in seconds."""
+    iterations = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(iterations): func()
+        elapsed = time.perf_counter() - t
+        if elapsed >= round_time or iterations >= 1 << 20: break
+        iterations = max(iterations * 2, int(iterations * round_time / max(elapsed, 1e-9)))
+    samples = [elapsed / iterations]
+    for _ in range(rounds - 1):
+        t = time.perf_counter()
+        for _ in range(iterations): func()
+        samples.append((time.perf_counter() - t) / iterations)
+    return {"min": min(samples), "median": statistics.median(samples), "mean": statistics.fmean(samples),
+            "stddev": statistics.stdev(samples) if len(samples) > 1 else 0.0, "rounds": len(samples), "iterations": iterations}
+
+
+@contextlib.contextmanager
+def stats_with_users(directory: str, users: int):
+    use_temp_data_files(directory)
+    stats = seed_stats(users)
+    for i, record in enumerate(stats["users"].values()):
+        if i % 5 == 0: record.add_payment("PayPal", "10 Bilder", 5)
+        if i % 7 == 0: record.discounts = {"type": "percent", "value": 10}
+    bot.save_stats(stats)
+    try: yield bot.load_stats()
+    finally: bot.STATS_STORE.close()
+
+
+def reload_stats():
+    bot.STATS_STORE.stats = None; bot.load_stats()
+
+
+@contextlib.contextmanager
+def media_directory(directory: str, files: int):
+    """A MEDIA_DIR with `files` entries, a tenth of them preview media, the rest other uploads."""
+    original = bot.MEDIA_DIR; bot.MEDIA_DIR = directory
+    for i in range(files):
+        name = (f"bilder_vorschau_{i:06d}.jpg", f"videos_vorschau_{i:06d}.mp4")[i % 2] if i % 10 == 0 else f"upload_{i:06d}.jpg"
+        open(os.path.join(directory, name), "w").close()
+    try: yield
+    finally: bot.MEDIA_DIR = original
+
+
+def hotpath_cases(args):
+    """Yields (name, func); setup and teardown happen around each yield."""
+    for users in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp, stats_with_users(tmp, users) as stats:
+            yield f"load_stats[{users}]", reload_stats
+            yield f"save_stats full[{users}]", lambda: bot.save_stats(stats)
+            yield f"save_stats journaled[{users}]", lambda: bot.save_stats(stats, users=["0"])
+    context = SimpleNamespace(user_data={"language": "en"})
+    with tempfile.TemporaryDirectory() as tmp, stats_with_users(tmp, 100):
+        yield "get_package_button_text", lambda: bot.get_package_button_text("bilder", 25, 0, context)
+        yield "get_price_keyboard", lambda: bot.get_price_keyboard(0, context)
+    yield "get_text", lambda: bot.get_text("main_menu_button", context)
+    yield "get_text with kwargs", lambda: bot.get_text("preview_caption", context, age_anna=bot.AGE_ANNA)
+    profiles = [None, {"type": "percent", "value": 15}, {"type": "euro_packages", "packages": {"bilder_10": 3}}, {"type": "percent_packages", "packages": {"videos_25": 20}}]
+    yield "get_discounted_price", lambda: [bot.get_discounted_price(40, profile, "bilder_10") for profile in profiles]
+    for files in args.media_files:
+        with tempfile.TemporaryDirectory() as tmp, media_directory(tmp, files):
+            yield f"get_media_files combined[{files}]", lambda: bot.get_media_files("combined", "vorschau")
+            yield f"get_media_files bilder[{files}]", lambda: bot.get_media_files("bilder", "vorschau")
+    vouchers = {"amazon": [f"AMZN-{i:04d}-XXXX-YYYY" for i in range(args.vouchers)]}
+    yield f"build_vouchers_pdf[{args.vouchers}]", lambda: bot.build_vouchers_pdf(vouchers)
+
+
+def format_seconds(value: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if value >= scale: return f"{value / scale:8.2f} {unit}"
+    return f"{value / 1e-9:8.0f} ns"
+
+
+def run_hotpaths(args) -> dict:
+    results = {}
+    for name, func in hotpath_cases(args):
+        if args.filter and args.filter not in name: continue
+        result = results[name] = measure(func, rounds=args.rounds)
+        print(f"{name:<40} median {format_seconds(result['median'])}   min {format_seconds(result['min'])}   stddev {format_seconds(result['stddev'])}   ({result['rounds']}x{result['iterations']})")
+    if args.save:
+        baseline = {"machine": {"python": platform.python_version(), "platform": platform.platform()}, "created": datetime.now().isoformat(timespec="seconds"), "benchmarks": results}
+        with open(args.baseline, "w") as f: json.dump(baseline, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    if args.compare:
+        with open(args.baseline) as f: baseline = json.load(f)["benchmarks"]
+        regressions = []
+        print(f"\nCompared with {args.baseline} (regression threshold +{args.threshold:.0%} on the median)")
+        for name, result in results.items():
+            if name not in baseline: print(f"{name:<40} new"); continue
+            change = result["median"] / baseline[name]["median"] - 1
+            flag = "REGRESSION" if change > args.threshold else ""
+            print(f"{name:<40} {change:+8.1%}  {flag}")
+            if flag: regressions.append(name)
+        if regressions: sys.exit(f"{len(regressions)} hot path(s) regressed: {', '.join(regressions)}")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="suite", required=True)
+    startup = sub.add_parser("startup", help="import, build and first-update latency")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--latency", type=float, default=0.05, help="simulated Bot API round-trip in seconds")
+    startup.set_defaults(func=run_startup)
+    ratelimit = sub.add_parser("ratelimit", help="burst traffic against a fake API enforcing Telegram's flood limits; exits non-zero on 429s, failed calls or replies served late")
+    ratelimit.add_argument("--users", type=int, default=200)
+    ratelimit.add_argument("--replies", type=int, default=2, help="user replies per user")
+    ratelimit.add_argument("--deletes", type=int, default=2, help="cleanup deletes per user")
+    ratelimit.add_argument("--admin-every", type=int, default=4, help="post an admin log for every n-th user")
+    ratelimit.add_argument("--scale", type=float, default=20, help="multiplier applied to all Telegram limits")
+    ratelimit.set_defaults(func=run_ratelimit)
+    records = sub.add_parser("records", help="memory per user and stats serialization cost")
+    records.add_argument("--users", type=int, default=1_000_000)
+    records.set_defaults(func=run_records)
+    prices = sub.add_parser("prices", help="price matrix equivalence check and lookup cost")
+    prices.add_argument("--profiles", type=int, default=5000)
+    prices.add_argument("--renders", type=int, default=100_000)
+    prices.add_argument("--seed", type=int, default=0)
+    prices.set_defaults(func=run_prices)
+    journal = sub.add_parser("journal", help="journal vs. full rewrite cost and crash-injection recovery check")
+    journal.add_argument("--users", type=int, default=10_000)
+    journal.add_argument("--mutations", type=int, default=200)
+    journal.add_argument("--crashes", type=int, default=30)
+    journal.add_argument("--crash-users", type=int, default=50)
+    journal.add_argument("--seed", type=int, default=0)
+    journal.add_argument("--child", help=argparse.SUPPRESS)
+    journal.add_argument("--checkpoint-every", type=int, default=50, help=argparse.SUPPRESS)
+    journal.add_argument("--crash-in-checkpoint", default="", help=argparse.SUPPRESS)
+    journal.set_defaults(func=run_journal)
+    hotpaths = sub.add_parser("hotpaths", help="micro-benchmarks of the hot paths, with a baseline to catch regressions")
+    hotpaths.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="user counts for load_stats/save_stats")
+    hotpaths.add_argument("--media-files", type=int, nargs="+", default=[1_000, 20_000], help="files in the media directory")
+    hotpaths.add_argument("--vouchers", type=int, default=500)
+    hotpaths.add_argument("--rounds", type=int, default=7)
+    hotpaths.add_argument("--filter", help="only run benchmarks whose name contains this")
+    hotpaths.add_argument("--baseline", default=BASELINE_FILE)
+    hotpaths.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    hotpaths.add_argument("--compare", action="store_true", help="exit non-zero if a median is slower than the baseline by more than --threshold")
+    hotpaths.add_argument("--threshold", type=float, default=0.25)
+    hotpaths.set_defaults(func=run_hotpaths)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,18 +4,38 @@ import json
 import random
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 import asyncio
+import contextlib
+import contextvars
+import csv
+import gzip
+import sys
+import threading
+from collections import Counter, OrderedDict
+import tempfile
 import re
+import struct
+import time
+import hashlib
+import heapq
+import itertools
+import mmap
+import warnings
+import zlib
+from dataclasses import dataclass, field
+from functools import lru_cache
 from math import ceil
+from types import MappingProxyType
 
-from fpdf import FPDF
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, error, InputMediaPhoto, InputMediaVideo, User
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, error, InputMediaPhoto, InputMediaVideo, Message, User
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
@@ -32,6 +52,20 @@ TELEGRAM_USERNAME = os.getenv("TELEGRAM_USERNAME", "ANNASPICY")
 
 AGE_ANNA = os.getenv("AGE_ANNA", "18")
 
+# Opt-in handler profiling, e.g. PROFILE_HANDLERS=1 PROFILE_SAMPLE_RATE=0.1
+PROFILE_HANDLERS = os.getenv("PROFILE_HANDLERS", "").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.05"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Album mode sends previews as media groups of up to PREVIEW_ALBUM_SIZE items instead of one medium per click
+PREVIEW_ALBUM_MODE = os.getenv("PREVIEW_ALBUM_MODE", "").lower() in ("1", "true", "yes")
+# Private chat that media is uploaded to at startup so its file_ids are cached; defaults to the admin group, then the admin
+MEDIA_CACHE_CHAT_ID = os.getenv("MEDIA_CACHE_CHAT_ID")
+# Records anonymized incoming updates for offline replay with replay.py, e.g. RECORD_UPDATES=traffic.jsonl.gz
+# Every start writes its own recording; if the file exists, the start time is added to the name
+RECORD_UPDATES = os.getenv("RECORD_UPDATES")
+# Event loop stalls longer than this (seconds) are reported with the stack of the blocking code
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.1"))
+
 BTC_WALLET = "1FcgMLNBDLiuDSDip7AStuP19sq47LJB12"
 ETH_WALLET = "0xeeb8FDc4aAe71B53934318707d0e9747C5c66f6e"
 
@@ -45,169 +79,548 @@ VOUCHER_FILE = "vouchers.json"
 STATS_FILE = "stats.json"
 MEDIA_DIR = "image"
 DISCOUNT_MSG_HEADER = "--- BOT DISCOUNT DATA (DO NOT DELETE) ---"
+STATS_ARCHIVE_FILE = "stats_archive.jsonl"
+MEDIA_CACHE_FILE = "media_cache.json"
+LOCALES_DIR = "locales"
+TEXT_CATALOG_FILE = os.path.join(LOCALES_DIR, "texts.cat")
+DEFAULT_LANGUAGE = "de"
+FALLBACK_LANGUAGE = "en"
+TEXT_RELOAD_INTERVAL = timedelta(seconds=30)
+JOURNAL_SYNC_INTERVAL = 0.05  # Group commit window for journal fsyncs, in seconds
+CHECKPOINT_INTERVAL = timedelta(minutes=5)
+CHECKPOINT_JOURNAL_BYTES = 4 * 1024 * 1024
+RETENTION_INACTIVE_DAYS = int(os.getenv("RETENTION_INACTIVE_DAYS", "180"))
+RETENTION_TRIM_DAYS = 30
+RETENTION_TRIMMED_PAYMENTS = 5
+MAINTENANCE_INTERVAL = timedelta(hours=24)
+PREVIEW_CLICK_LIMIT = 25
+PREVIEW_ALBUM_SIZE = 10  # Telegram's maximum for send_media_group
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.m4v')
+PREUPLOAD_CONCURRENCY = 3
+CONVERSATION_STATE_TIMEOUT = timedelta(minutes=30)
+CONVERSATION_STATE_TICK = 10  # Seconds per timer wheel slot
+CONVERSATION_STATE_SLOTS = 256
+LOOP_LAG_INTERVAL = 0.05  # Heartbeat period of the loop lag monitor, in seconds
+LOOP_LAG_ALERT_INTERVAL = 60  # At most one logged alert per blocking location in this many seconds
+PREUPLOAD_MAX_ATTEMPTS = 3
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-# --- I18N and Text Management ---
+# --- Outbound Rate Limiting ---
+# Priority lanes for outbound Bot API calls (lower value is served first)
+PRIORITY_USER_REPLY = 0
+PRIORITY_ADMIN_LOG = 1
+PRIORITY_CLEANUP = 2
+# Telegram's documented limits: ~30 messages/s overall, ~1 message/s per chat, 20 messages/min per group
+OVERALL_RATE_PER_SECOND = 30
+CHAT_RATE_PER_SECOND = 1
+CHAT_BURST = 3
+GROUP_RATE_PER_SECOND = 20 / 60
+GROUP_BURST = 20
+MESSAGE_ENDPOINT_PREFIXES = ("send", "edit", "copy", "forward")
+
+def retry_after_seconds(exc: error.RetryAfter) -> float:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # int vs. timedelta deprecation in newer PTB versions
+        retry_after = exc.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+class TokenBucket:
+    """Token bucket whose waiters are served in priority order."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._condition = asyncio.Condition()
+
+    def _delay(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+        token_delay = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        return max(self.blocked_until - now, token_delay, 0.0)
+
+    def is_idle(self) -> bool:
+        return not self._waiters and self._delay(time.monotonic()) == 0.0 and self.tokens >= self.capacity
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, priority: int):
+        entry = (priority, next(self._sequence))
+        async with self._condition:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    delay = self._delay(time.monotonic()) if self._waiters[0] == entry else None
+                    if delay == 0.0: break
+                    try: await asyncio.wait_for(self._condition.wait(), delay)
+                    except asyncio.TimeoutError: pass
+                self.tokens -= 1
+            finally:
+                self._waiters.remove(entry); heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Schedules outbound calls through overall, per-chat and per-group token buckets.
+
+    ``rate_limit_args`` may be passed to any bot method to set the priority explicitly; otherwise
+    deletes are treated as cleanup, posts to the notification group as admin logs and everything
+    else as user replies. Calls without a ``chat_id`` (e.g. ``answerCallbackQuery``) are not limited.
+    """
+
+    def __init__(self, overall_rate: float = OVERALL_RATE_PER_SECOND, chat_rate: float = CHAT_RATE_PER_SECOND, chat_burst: float = CHAT_BURST,
+                 group_rate: float = GROUP_RATE_PER_SECOND, group_burst: float = GROUP_BURST, max_retries: int = 2):
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.group_rate, self.group_burst = group_rate, group_burst
+        self.max_retries = max_retries
+        # One token of headroom: calls reach Telegram a little later and less evenly than they leave the bucket
+        self._overall = TokenBucket(overall_rate, max(1.0, overall_rate - 1))
+        self._chats = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def is_group(chat_id) -> bool:
+        return isinstance(chat_id, str) or chat_id < 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                self._chats = {key: b for key, b in self._chats.items() if not b.is_idle()}
+            bucket = TokenBucket(self.group_rate, self.group_burst) if self.is_group(chat_id) else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    @staticmethod
+    def priority_for(endpoint: str, chat_id) -> int:
+        if endpoint.startswith("delete"): return PRIORITY_CLEANUP
+        if NOTIFICATION_GROUP_ID and str(chat_id) == str(NOTIFICATION_GROUP_ID): return PRIORITY_ADMIN_LOG
+        return PRIORITY_USER_REPLY
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None: return await callback(*args, **kwargs)
+        try: chat_id = int(chat_id)
+        except (TypeError, ValueError): pass
+        priority = rate_limit_args if rate_limit_args is not None else self.priority_for(endpoint, chat_id)
+        # The 20 per minute group limit is for new messages; edits (e.g. admin logs) only count against the overall rate
+        counts_for_chat = endpoint.startswith(MESSAGE_ENDPOINT_PREFIXES) and not (endpoint.startswith("edit") and self.is_group(chat_id))
+        chat_bucket = self._chat_bucket(chat_id) if counts_for_chat else None
+
+        for attempt in range(self.max_retries + 1):
+            if chat_bucket: await chat_bucket.acquire(priority)
+            await self._overall.acquire(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except error.RetryAfter as exc:
+                if attempt == self.max_retries: raise
+                sleep = retry_after_seconds(exc)
+                logger.warning(f"Flood limit hit on {endpoint} for chat {chat_id}, retrying in {sleep}s")
+                (chat_bucket or self._overall).block(sleep)
 
-texts = {
-    # General
-    "back_button": {"de": "« Zurück", "en": "« Back"},
-    "main_menu_button": {"de": "« Zurück zum Hauptmenü", "en": "« Back to Main Menu"},
-    "cancel_button": {"de": "Abbrechen", "en": "Cancel"},
-    "error_occurred": {"de": "Ups! Es ist ein Fehler aufgetreten. Bitte versuche es erneut, indem du /start sendest.", "en": "Oops! An error occurred. Please try again by sending /start."},
-    "banned_user_message": {"de": "Du bist von der Nutzung dieses Bots ausgeschlossen.", "en": "You are banned from using this bot."},
-    "banned_user_alert": {"de": "Du bist von der Nutzung dieses Bots ausgeschlossen.", "en": "You are banned from using this bot."},
-
-    # Language Selection
-    "language_selection_prompt": {"de": "Bitte wähle deine Sprache:", "en": "Please select your language:"},
-
-    # Start/Main Menu
-    "welcome_text": {"de": "Herzlich Willkommen! ✨\n\nHier kannst du eine Vorschau meiner Inhalte sehen oder direkt ein Paket auswählen. Die gesamte Bedienung erfolgt über die Buttons.", "en": "Welcome! ✨\n\nHere you can see a preview of my content or select a package directly. The entire operation is done via the buttons."},
-    "preview_button": {"de": "🖼️ Vorschau", "en": "🖼️ Preview"},
-    "packages_button": {"de": "🛍️ Bilder & Videos", "en": "🛍️ Pictures & Videos"},
-    "live_call_button": {"de": "📞 Live Call", "en": "📞 Live Call"},
-    "meeting_button": {"de": "📅 Treffen buchen", "en": "📅 Book a Meeting"},
-
-    # Discount Message
-    "discount_offer_text": {
-        "de": "🎁 Wir haben dich vermisst! 🎁\n\nAls Willkommensgruß erhältst du einen exklusiven **10% Rabatt** auf alle Pakete!\n\nPLUS: Unser **2-für-1 PayPal-Angebot** gilt weiterhin für dich. Nutze die Chance!",
-        "en": "🎁 We've missed you! 🎁\n\nAs a welcome back gift, you receive an exclusive **10% discount** on all packages!\n\nPLUS: Our **2-for-1 PayPal offer** is still valid for you. Take the chance!"
-    },
-    "discount_text": {"de": "Rabatt", "en": "Discount"},
-    "discount_offer_button": {"de": "💸 Zu meinen exklusiven Preisen 💸", "en": "💸 To my exclusive prices 💸"},
-
-    # Preview
-    "preview_caption": {"de": "Hier ist eine Vorschau. Ich bin {age_anna} Jahre alt. Klicke auf 'Nächstes Medium' für mehr.", "en": "Here is a preview. I am {age_anna} years old. Click 'Next Medium' for more."},
-    "no_preview_content": {"de": "Ups! Ich konnte gerade keine passenden Inhalte finden...", "en": "Oops! I couldn't find any suitable content right now..."},
-    "next_medium_button": {"de": "🖼️ Nächstes Medium", "en": "🖼️ Next Medium"},
-    "prices_and_packages_button": {"de": "🛍️ Preise & Pakete", "en": "🛍️ Prices & Packages"},
-    "preview_limit_reached_alert": {"de": "Du hast dein Vorschau-Limit von 25 Klicks bereits erreicht.", "en": "You have already reached your preview limit of 25 clicks."},
-    "preview_limit_reached_text": {"de": "Du hast dein Vorschau-Limit von 25 Klicks erreicht. Sieh dir jetzt die Preise an, um mehr zu sehen!", "en": "You have reached your preview limit of 25 clicks. Check out the prices now to see more!"},
-    "view_prices_button": {"de": "🛍️ Preise ansehen", "en": "🛍️ View Prices"},
-
-    # Prices Page
-    "select_package_caption": {"de": "Wähle dein gewünschtes Paket:", "en": "Choose your desired package:"},
-    "package_button_text_bilder": {"de": "{amount} Bilder", "en": "{amount} Pictures"},
-    "package_button_text_videos": {"de": "{amount} Videos", "en": "{amount} Videos"},
-
-    # Package Selection
-    "package_selection_text": {"de": "Du hast das Paket **{amount} {media_type}** für {price_str} ausgewählt.\n\nWie möchtest du bezahlen?", "en": "You have selected the **{amount} {media_type}** package for {price_str}.\n\nHow would you like to pay?"},
-    "paypal_offer_text": {"de": "\n\n🔥 *PayPal-Aktion: Kaufe 1, erhalte 2!* 🔥", "en": "\n\n🔥 *PayPal Offer: Buy 1, get 2!* 🔥"},
-    "paypal_button": {"de": " PayPal", "en": " PayPal"},
-    "voucher_button": {"de": " Gutschein (Amazon)", "en": " Voucher (Amazon)"},
-    "crypto_button": {"de": "🪙 Krypto", "en": "🪙 Crypto"},
-    "back_to_prices_button": {"de": "« Zurück zu den Preisen", "en": "« Back to Prices"},
-
-    # Payment
-    "paypal_payment_text": {"de": "Super! Klicke auf den Link, um die Zahlung für **{package_info_text}** in Höhe von **{price}€** abzuschließen...\n\n➡️ [Hier sicher bezahlen]({paypal_link})\n\n", "en": "Great! Click the link to complete the payment for **{package_info_text}** amounting to **{price}€**...\n\n➡️ [Pay securely here]({paypal_link})\n\n"},
-    "contact_after_payment_text": {"de": "📲 *Melde dich danach bei @{TELEGRAM_USERNAME} mit einem Screenshot!*", "en": "📲 *Contact @{TELEGRAM_USERNAME} with a screenshot afterwards!*"},
-    "voucher_prompt_text": {"de": "Bitte sende mir jetzt deinen Amazon-Gutschein-Code als einzelne Nachricht.", "en": "Please send me your Amazon voucher code as a single message now."},
-    "crypto_prompt_text": {"de": "Bitte wähle die gewünschte Kryptowährung:", "en": "Please choose the desired cryptocurrency:"},
-    "crypto_payment_text": {"de": "Zahlung mit **{crypto_name}** für **{price}€**.\n\n`{wallet_address}`", "en": "Payment with **{crypto_name}** for **{price}€**.\n\n`{wallet_address}`"},
-
-    # Vouchers
-    "voucher_submitted_text": {"de": "✅ Vielen Dank! Dein Gutschein wurde übermittelt.\n\nDie manuelle Überprüfung dauert ca. **10-20 Minuten**. Sobald dein Code verifiziert ist, melde ich mich bei dir.", "en": "✅ Thank you! Your voucher has been submitted.\n\nThe manual verification takes about **10-20 minutes**. I will contact you as soon as your code is verified."},
-
-    # Live Call
-    "live_call_menu_text": {"de": "📞 Wähle die gewünschte Dauer für deinen Live Call:", "en": "📞 Choose the desired duration for your Live Call:"},
-    "live_call_unit_min": {"de": "{duration} Min", "en": "{duration} min"},
-    "live_call_unit_hr": {"de": "{hours} Std", "en": "{hours} hr"},
-    "live_call_available_text": {"de": "✅ Ich bin für deinen Call verfügbar!", "en": "✅ I am available for your call!"},
-    "live_call_selection_text": {"de": "Du hast einen **Live Call** für **{amount} Minuten** für *{price}€* ausgewählt.\n\nBitte schließe die Bezahlung ab und melde dich danach bei **@{TELEGRAM_USERNAME}** mit einem Screenshot.", "en": "You have selected a **Live Call** for **{amount} minutes** for *{price}€*.\n\nPlease complete the payment and then contact **@{TELEGRAM_USERNAME}** with a screenshot."},
-    "package_info_live_call": {"de": "{amount} Min Live Call", "en": "{amount} min Live Call"},
-
-
-    # Meeting
-    "meeting_menu_text": {"de": "📅 Wähle die gewünschte Dauer für dein Treffen:", "en": "📅 Choose the desired duration for your meeting:"},
-    "meeting_duration_1_hour": {"de": "1 Stunde", "en": "1 hour"},
-    "meeting_duration_2_hours": {"de": "2 Stunden", "en": "2 hours"},
-    "meeting_duration_4_hours": {"de": "4 Stunden", "en": "4 hours"},
-    "meeting_duration_1_day": {"de": "1 Tag", "en": "1 day"},
-    "meeting_duration_2_days": {"de": "2 Tage", "en": "2 days"},
-    "meeting_deposit_info_button": {"de": "🤔 Warum eine Anzahlung?", "en": "🤔 Why a deposit?"},
-    "meeting_deposit_info_text": {
-        "de": ("🤔 **Warum eine kleine Anzahlung?** 🤔\n\n"
-               "Ganz einfach: Sie ist eine kleine Sicherheit für uns beide! 🤝\n\n"
-               "1️⃣ **Für dich:** Dein Termin ist damit fest für dich geblockt und niemand kann ihn dir wegschnappen. 🔒\n"
-               "2️⃣ **Für mich:** Sie hilft mir, meine Anreise zu planen ✈️ und schützt mich vor Spaßbuchungen. So weiß ich, dass du es auch wirklich ernst meinst. 😊\n\n"
-               "Den großen Rest zahlst du dann ganz entspannt und diskret in bar, wenn wir uns sehen. 💸"),
-        "en": ("🤔 **Why a small deposit?** 🤔\n\n"
-               "It's simple: it's a small security for both of us! 🤝\n\n"
-               "1️⃣ **For you:** Your appointment is firmly booked for you and nobody can take it away. 🔒\n"
-               "2️⃣ **For me:** It helps me plan my travel ✈️ and protects me from fake bookings. This way I know you are serious about it. 😊\n\n"
-               "You'll pay the rest relaxed and discreetly in cash when we meet. 💸")
-    },
-    "understood_back_button": {"de": "« Verstanden & zurück", "en": "« Understood & back"},
-    "understood_back_to_payment_button": {"de": "« Verstanden & zurück zur Zahlung", "en": "« Understood & back to payment"},
-    "meeting_date_prompt": {"de": "📅 Bitte gib dein Wunschdatum ein (z.B. `24.12`):", "en": "📅 Please enter your desired date (e.g., `24.12`):"},
-    "invalid_date_prompt": {"de": "Das war leider kein gültiges Datum. 😕\n\nBitte gib dein Wunschdatum nochmal ein (z.B. `24.12`):", "en": "That was not a valid date. 😕\n\nPlease enter your desired date again (e.g., `24.12`):"},
-    "meeting_location_prompt": {"de": "📍 Super! Und an welchem Ort (z.B. Stadt)?", "en": "📍 Great! And at what location (e.g., city)?"},
-    "meeting_summary_error": {"de": "Ein Fehler ist aufgetreten. Bitte beginne die Buchung erneut.", "en": "An error has occurred. Please start the booking again."},
-    "back_to_meeting_menu_button": {"de": "« Zum Treffen-Menü", "en": "« To Meeting Menu"},
-    "meeting_available_status": {"de": "Status: ✅ Dein Wunschtermin ist verfügbar!", "en": "Status: ✅ Your desired date is available!"},
-    "meeting_summary_title": {"de": "📅 **Deine Terminanfrage:**\n\n", "en": "📅 **Your Appointment Request:**\n\n"},
-    "meeting_summary_duration": {"de": "**Dauer:** {duration_text}\n", "en": "**Duration:** {duration_text}\n"},
-    "meeting_summary_date": {"de": "**Datum:** {date}\n", "en": "**Date:** {date}\n"},
-    "meeting_summary_location": {"de": "**Ort:** {location}\n\n", "en": "**Location:** {location}\n\n"},
-    "meeting_summary_total_price": {"de": "**Gesamtpreis:** {full_price}€\n", "en": "**Total Price:** {full_price}€\n"},
-    "meeting_summary_cash_discount": {"de": "**Barzahler-Rabatt (10%):** -{discount_amount:.2f}€\n", "en": "**Cash Payment Discount (10%):** -{discount_amount:.2f}€\n"},
-    "meeting_summary_final_price": {"de": "**Neuer Endpreis (bei Barzahlung):** **{cash_price:.2f}€**\n\n", "en": "**New Final Price (with cash payment):** **{cash_price:.2f}€**\n\n"},
-    "meeting_summary_deposit_info": {"de": "Zur Verifizierung ist eine **Anzahlung von 25% ({deposit}€)** erforderlich. Der Restbetrag wird in bar beim Treffen bezahlt.", "en": "A **deposit of 25% ({deposit}€)** is required for verification. The remaining amount will be paid in cash at the meeting."},
-    "deposit_info_button_summary": {"de": "🤔 Warum diese Anzahlung?", "en": "🤔 Why this deposit?"},
-    "deposit_paypal_button": {"de": "💸 Anzahlung ({deposit}€) per PayPal", "en": "💸 Deposit ({deposit}€) via PayPal"},
-    "deposit_voucher_button": {"de": "🎟️ Anzahlung ({deposit}€) per Gutschein", "en": "🎟️ Deposit ({deposit}€) via Voucher"},
-    "deposit_crypto_button": {"de": "🪙 Anzahlung ({deposit}€) per Krypto", "en": "🪙 Deposit ({deposit}€) via Crypto"},
-    "cancel_booking_button": {"de": "« Buchung abbrechen", "en": "« Cancel Booking"},
-    "package_info_meeting_deposit": {"de": "Anzahlung Treffen ({duration_text})", "en": "Deposit for Meeting ({duration_text})"},
-}
+
+# --- I18N and Text Management ---
+# Texts live in locales/<lang>.json; adding a language means adding a file. They are compiled into one
+# binary table that is memory-mapped, so a lookup is two dict hits and a slice whatever the number of languages.
+#
+# Layout: header | language codes | key table | text table (n_keys x n_langs) | UTF-8 blob.
+# Table entries are (offset, length) into the blob; missing translations already point at the fallback text.
+TEXT_CATALOG_MAGIC = b"TXC1"
+TEXT_HEADER = struct.Struct("<4sII")  # magic, language count, key count
+TEXT_LANGUAGE = struct.Struct("<8s")
+TEXT_ENTRY = struct.Struct("<II")
+
+def text_sources(source_dir: str | None = None) -> list:
+    source_dir = source_dir or LOCALES_DIR
+    if not os.path.isdir(source_dir): return []
+    return sorted(os.path.join(source_dir, name) for name in os.listdir(source_dir) if name.endswith(".json"))
+
+def compile_text_catalog(source_dir: str | None = None, output_path: str | None = None) -> int:
+    """Compiles the JSON sources into the binary catalog and returns the number of keys."""
+    output_path = output_path or TEXT_CATALOG_FILE; catalogs = {}
+    for path in text_sources(source_dir):
+        with open(path, "r", encoding="utf-8") as f: catalogs[os.path.splitext(os.path.basename(path))[0]] = json.load(f)
+    languages = sorted(catalogs, key=lambda lang: lang != FALLBACK_LANGUAGE)  # Fallback first, so it is index 0
+    keys = list(dict.fromkeys(key for lang in languages for key in catalogs[lang]))
+    blob = bytearray(); blob_offsets = {}
+
+    def add(text: str) -> bytes:
+        data = text.encode("utf-8")
+        if data not in blob_offsets: blob_offsets[data] = len(blob); blob.extend(data)
+        return TEXT_ENTRY.pack(blob_offsets[data], len(data))
+
+    key_table = b"".join(add(key) for key in keys); text_table = bytearray()
+    for key in keys:
+        fallback = catalogs.get(FALLBACK_LANGUAGE, {}).get(key)
+        for lang in languages:
+            text_table += add(catalogs[lang].get(key) or fallback or f"<{key}_{lang}_NOT_FOUND>")
+    header = TEXT_HEADER.pack(TEXT_CATALOG_MAGIC, len(languages), len(keys)) + b"".join(TEXT_LANGUAGE.pack(lang.encode("ascii")) for lang in languages)
+    # Offsets are relative to the blob start, so shift them once the table sizes are known
+    base = len(header) + len(key_table) + len(text_table)
+    key_table, text_table = (b"".join(TEXT_ENTRY.pack(offset + base, length) for offset, length in TEXT_ENTRY.iter_unpack(table)) for table in (key_table, text_table))
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "wb") as f: f.write(header + key_table + text_table + blob)
+    os.replace(tmp_path, output_path)  # Readers keep their mapping of the old file
+    return len(keys)
+
+class TextCatalog:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ); stat = os.fstat(f.fileno())
+        self.path = path; self.version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        magic, language_count, key_count = TEXT_HEADER.unpack_from(self.mapping, 0)
+        if magic != TEXT_CATALOG_MAGIC: raise ValueError(f"{path} is not a text catalog")
+        languages = [TEXT_LANGUAGE.unpack_from(self.mapping, TEXT_HEADER.size + i * TEXT_LANGUAGE.size)[0].rstrip(b"\0").decode("ascii") for i in range(language_count)]
+        key_table = TEXT_HEADER.size + language_count * TEXT_LANGUAGE.size
+        self.text_table = key_table + key_count * TEXT_ENTRY.size
+        self.language_count = language_count; self.languages = {lang: i for i, lang in enumerate(languages)}
+        self.keys = {self._read(key_table + i * TEXT_ENTRY.size): i for i in range(key_count)}
+        self.cache = {}  # Decoded texts by table slot; only the texts actually used are ever decoded
+
+    def _read(self, entry_offset: int) -> str:
+        offset, length = TEXT_ENTRY.unpack_from(self.mapping, entry_offset)
+        return self.mapping[offset:offset + length].decode("utf-8")
+
+    def lookup(self, key: str, lang: str) -> str:
+        key_index = self.keys.get(key)
+        if key_index is None: return f"<{key}_{lang}_NOT_FOUND>"
+        slot = key_index * self.language_count + self.languages.get(lang, 0)
+        text = self.cache.get(slot)
+        if text is None: text = self.cache[slot] = self._read(self.text_table + slot * TEXT_ENTRY.size)
+        return text
+
+    def is_stale(self) -> bool:
+        """True if a source is newer than the catalog or the catalog file was replaced."""
+        try: stat = os.stat(self.path)
+        except FileNotFoundError: return True
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self.version: return True
+        return any(os.stat(path).st_mtime_ns > stat.st_mtime_ns for path in text_sources())
+
+TEXT_CATALOG: TextCatalog | None = None
+
+def load_text_catalog() -> TextCatalog:
+    """Maps the compiled catalog, compiling it first if it is missing or older than its sources."""
+    global TEXT_CATALOG
+    sources = text_sources()
+    try: catalog_mtime = os.stat(TEXT_CATALOG_FILE).st_mtime_ns
+    except FileNotFoundError: catalog_mtime = -1
+    if sources and any(os.stat(path).st_mtime_ns > catalog_mtime for path in sources):
+        logger.info(f"Compiled {compile_text_catalog()} texts from {len(sources)} language files into {TEXT_CATALOG_FILE}")
+    TEXT_CATALOG = TextCatalog(TEXT_CATALOG_FILE)  # The previous mapping is released once unreferenced
+    return TEXT_CATALOG
+
+async def reload_text_catalog_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if TEXT_CATALOG is None or TEXT_CATALOG.is_stale():
+            catalog = load_text_catalog(); logger.info(f"Reloaded text catalog: {len(catalog.keys)} keys, {len(catalog.languages)} languages")
+    except (OSError, ValueError) as e: logger.error(f"Could not reload text catalog, keeping the current one: {e}")
 
 def get_text(key: str, context: ContextTypes.DEFAULT_TYPE, **kwargs) -> str:
     """Fetches a string in the user's chosen language."""
-    lang = context.user_data.get('language', 'de')  # Default to German
-    text_template = texts.get(key, {}).get(lang) or texts.get(key, {}).get('en', f"<{key}_{lang}_NOT_FOUND>")
+    lang = context.user_data.get('language', DEFAULT_LANGUAGE)
+    text_template = (TEXT_CATALOG or load_text_catalog()).lookup(key, lang)
     return text_template.format(**kwargs) if kwargs else text_template
 
+# --- User Records ---
+FLAG_BANNED = 1
+FLAG_DISCOUNT_SENT = 2
+FLAG_PAYPAL_OFFER_SENT = 4
+MAX_PAYMENT_ENTRIES = 20
+LEGACY_PAYMENT_PATTERN = re.compile(r"^(.*) \((.*)\): (\d+)€$")
+
+def to_epoch(value) -> int:
+    """Accepts an epoch int or a legacy ISO timestamp string."""
+    if isinstance(value, str): return int(datetime.fromisoformat(value).timestamp())
+    return int(value or 0)
+
+@dataclass(slots=True)
+class PaymentEntry:
+    method: str
+    package: str
+    price: int
+
+    def __str__(self) -> str:
+        return f"{self.method} ({self.package}): {self.price}€"
+
+    @classmethod
+    def from_json(cls, data) -> "PaymentEntry":
+        if isinstance(data, str):  # Legacy "Methode (Paket): 10€" strings
+            match = LEGACY_PAYMENT_PATTERN.match(data)
+            return cls(match.group(1), match.group(2), int(match.group(3))) if match else cls(data, "", 0)
+        return cls(data[0], data[1], data[2])
+
+def _flag_property(flag: int):
+    def getter(self) -> bool: return bool(self.flags & flag)
+    def setter(self, value: bool): self.flags = self.flags | flag if value else self.flags & ~flag
+    return property(getter, setter)
+
+@dataclass(slots=True)
+class UserRecord:
+    """Per-user stats entry; timestamps are epoch seconds and boolean state is packed into ``flags``."""
+    first_start: int = 0
+    last_start: int = 0
+    flags: int = 0
+    preview_clicks: int = 0
+    payments: list = field(default_factory=list)
+    discounts: dict | None = None
+
+    banned = _flag_property(FLAG_BANNED)
+    discount_sent = _flag_property(FLAG_DISCOUNT_SENT)
+    paypal_offer_sent = _flag_property(FLAG_PAYPAL_OFFER_SENT)
+
+    @classmethod
+    def new(cls) -> "UserRecord":
+        now = int(time.time())
+        return cls(first_start=now, last_start=now)
+
+    def add_payment(self, method: str, package: str, price: int) -> bool:
+        """Records a payment attempt, keeping only the most recent ``MAX_PAYMENT_ENTRIES``."""
+        entry = PaymentEntry(method, package, price)
+        if entry in self.payments: return False
+        self.payments.append(entry)
+        del self.payments[:-MAX_PAYMENT_ENTRIES]
+        return True
+
+    def to_json(self) -> dict:
+        data = {"first_start": self.first_start, "last_start": self.last_start, "flags": self.flags, "preview_clicks": self.preview_clicks}
+        if self.payments: data["payments"] = [[p.method, p.package, p.price] for p in self.payments]
+        if self.discounts is not None: data["discounts"] = self.discounts
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict) -> "UserRecord":
+        flags = data.get("flags", 0)
+        # Legacy records store each flag as its own boolean
+        if data.get("banned"): flags |= FLAG_BANNED
+        if data.get("discount_sent"): flags |= FLAG_DISCOUNT_SENT
+        if data.get("paypal_offer_sent"): flags |= FLAG_PAYPAL_OFFER_SENT
+        payments = [PaymentEntry.from_json(p) for p in data.get("payments", data.get("payments_initiated", []))][-MAX_PAYMENT_ENTRIES:]
+        return cls(to_epoch(data.get("first_start")), to_epoch(data.get("last_start")), flags, data.get("preview_clicks", 0), payments, data.get("discounts"))
+
+def encode_stats_object(obj):
+    if isinstance(obj, UserRecord): return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
 # --- Helper Functions ---
 def load_vouchers():
     try:
         with open(VOUCHER_FILE, "r") as f: return json.load(f)
     except (FileNotFoundError, json.JSONDecodeError): return {"amazon": []}
 
+def write_json_atomic(path: str, data, **dump_kwargs):
+    """Writes to a temporary file and renames it over ``path``, so readers never see a half-written file."""
+    replace_synced(write_json_synced(f"{path}.tmp", data, **dump_kwargs), path)
+
+def write_json_synced(tmp_path: str, data, **dump_kwargs) -> str:
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, **dump_kwargs); f.flush(); os.fsync(f.fileno())
+    return tmp_path
+
+def replace_synced(tmp_path: str, path: str):
+    os.replace(tmp_path, path)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try: os.fsync(dir_fd)
+        finally: os.close(dir_fd)
+    except OSError: pass  # Directory fsync is not supported everywhere
+
 def save_vouchers(vouchers):
-    with open(VOUCHER_FILE, "w") as f: json.dump(vouchers, f, indent=2)
+    write_json_atomic(VOUCHER_FILE, vouchers, indent=2)
 
-def load_stats():
+# --- Stats Persistence ---
+# Stats live in memory and every handler shares the same dict. save_stats() appends the changed
+# entries to a write-ahead journal (STATS_FILE + ".journal"); the full file is only rewritten at
+# checkpoints. On startup the last checkpoint is loaded and the journal replayed on top of it.
+
+def empty_stats() -> dict:
+    return {"users": {}, "admin_logs": {}, "events": {}}
+
+def read_stats_file(path: str) -> dict:
     try:
-        with open(STATS_FILE, "r") as f: return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"users": {}, "admin_logs": {}, "events": {}}
+        with open(path, "r") as f: stats = json.load(f)
+    except FileNotFoundError:
+        return empty_stats()
+    except json.JSONDecodeError as e:
+        # Never silently start over: keep the damaged file for manual recovery
+        corrupt_path = f"{path}.corrupt-{int(time.time())}"
+        os.replace(path, corrupt_path)
+        logger.error(f"{path} is corrupt ({e}), moved it to {corrupt_path} and starting from the journal only.")
+        return empty_stats()
+    for section in ("users", "admin_logs", "events"): stats.setdefault(section, {})
+    stats["users"] = {user_id: UserRecord.from_json(data) for user_id, data in stats["users"].items()}
+    return stats
+
+def encode_journal_line(entry: dict) -> bytes:
+    payload = json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+def decode_journal_line(line: bytes) -> dict | None:
+    """Returns None for torn or corrupted lines."""
+    if not line.endswith(b"\n") or len(line) < 10: return None
+    checksum, _, payload = line[:-1].partition(b" ")
+    try:
+        if int(checksum, 16) != zlib.crc32(payload): return None
+        return json.loads(payload)
+    except ValueError: return None
+
+def apply_journal_entry(stats: dict, entry: dict):
+    for op, key, value in entry["c"]:
+        if op == "key":
+            stats[key] = value; continue
+        section = {"user": "users", "event": "events", "admin_log": "admin_logs"}[op]
+        if value is None: stats[section].pop(key, None)
+        else: stats[section][key] = UserRecord.from_json(value) if op == "user" else value
+
+class StatsJournal:
+    """Append-only journal file; fsyncs of writes within JOURNAL_SYNC_INTERVAL are grouped into one."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = open(path, "ab")
+        self.size = self.f.tell()
+        self.sync_pending = False
+
+    def append(self, lines: bytes):
+        # Written to the OS right away, so a process crash loses nothing; only fsync is batched
+        self.f.write(lines); self.f.flush(); self.size += len(lines)
+        if self.sync_pending: return
+        try: loop = asyncio.get_running_loop()
+        except RuntimeError: self.sync(); return
+        self.sync_pending = True; loop.call_later(JOURNAL_SYNC_INTERVAL, self.sync)
+
+    def sync(self):
+        self.sync_pending = False
+        if not self.f.closed: os.fsync(self.f.fileno())
+
+    def reset(self):
+        self.f.seek(0); self.f.truncate(); self.sync(); self.size = 0
+
+    def discard_head(self, size: int):
+        """Drops the first size bytes, which a checkpoint now contains, and keeps what was appended after them."""
+        with open(self.path, "rb") as f: f.seek(size); tail = f.read()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f: f.write(tail); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)  # Never truncated in place, so a crash here cannot lose the tail
+        self.f.close(); self.f = open(self.path, "ab"); self.size = len(tail)
+
+    def close(self):
+        self.sync(); self.f.close()
+
+class StatsStore:
+    def __init__(self):
+        self.path = None; self.stats = None; self.journal = None; self.seq = 0
+        self.generation = 0; self.checkpointing = False; self.checkpoint_task = None  # generation counts checkpoints, so a slower background one cannot win
+
+    def load(self) -> dict:
+        if self.stats is None or self.path != STATS_FILE: self.recover()
+        return self.stats
+
+    def recover(self):
+        if self.journal: self.journal.close()
+        self.path = STATS_FILE; journal_path = f"{STATS_FILE}.journal"
+        stats = read_stats_file(STATS_FILE); self.seq = stats.get("journal_seq", 0); replayed = 0
+        if os.path.exists(journal_path):
+            valid_bytes = 0
+            with open(journal_path, "rb") as f:
+                for line in f:
+                    entry = decode_journal_line(line)
+                    if entry is None:
+                        logger.warning(f"Discarding torn journal tail at byte {valid_bytes} of {journal_path}."); break
+                    valid_bytes += len(line)
+                    if entry["s"] <= self.seq: continue  # Already contained in the checkpoint
+                    apply_journal_entry(stats, entry); self.seq = entry["s"]; replayed += 1
+            with open(journal_path, "r+b") as f: f.truncate(valid_bytes)
+        self.stats = stats; self.journal = StatsJournal(journal_path)
+        if replayed: logger.info(f"Recovered {replayed} journaled stats changes on top of {STATS_FILE}.")
+
+    def commit(self, changes: list):
+        # One line per commit, so a torn write drops the whole commit instead of half of it
+        self.seq += 1
+        self.journal.append(encode_journal_line({"s": self.seq, "c": changes}))
+        if self.journal.size > CHECKPOINT_JOURNAL_BYTES and not self.checkpointing:
+            try: self.checkpoint_task = asyncio.get_running_loop().create_task(self.checkpoint_in_background())
+            except RuntimeError: self.checkpoint()
+
+    def checkpoint(self, stats: dict | None = None):
+        if stats is not None and stats is not self.stats: self.load(); self.stats = stats
+        elif self.stats is None: return
+        self.stats["journal_seq"] = self.seq; self.generation += 1
+        write_json_atomic(STATS_FILE, self.stats, indent=4, default=encode_stats_object)
+        self.journal.reset()
+
+    def snapshot(self) -> dict:
+        """A copy of the stats that handlers can keep changing; records are already converted to JSON."""
+        stats = self.stats
+        return {**stats, "users": {user_id: record.to_json() for user_id, record in stats["users"].items()},
+                "admin_logs": {user_id: dict(log) for user_id, log in stats["admin_logs"].items()}, "events": dict(stats["events"]), "journal_seq": self.seq}
+
+    async def checkpoint_in_background(self):
+        """Like checkpoint(), but only the snapshot is taken on the event loop; encoding and writing run in a worker thread.
+
+        Changes journaled meanwhile stay in the journal, and the new file only replaces the old one if no other
+        checkpoint was written in the meantime.
+        """
+        if self.stats is None or self.checkpointing: return
+        self.checkpointing = True
+        try:
+            generation = self.generation; journal = self.journal; journal_size = journal.size; seq = self.seq
+            tmp_path = await asyncio.to_thread(write_json_synced, f"{STATS_FILE}.bg.tmp", self.snapshot(), indent=4)
+            if generation != self.generation or journal is not self.journal:
+                os.remove(tmp_path); return
+            replace_synced(tmp_path, STATS_FILE); self.generation += 1
+            if self.stats is not None: self.stats["journal_seq"] = seq
+            journal.discard_head(journal_size)
+        except Exception as e: logger.error(f"Background stats checkpoint failed: {e}")
+        finally: self.checkpointing = False
+
+    def close(self):
+        if self.stats is not None: self.checkpoint(); self.journal.close()
+        self.stats = None; self.journal = None
+
+STATS_STORE = StatsStore()
 
-def save_stats(stats):
-    with open(STATS_FILE, "w") as f: json.dump(stats, f, indent=4)
+def load_stats():
+    return STATS_STORE.load()
+
+def save_stats(stats, users=(), events=(), admin_logs=(), keys=()):
+    """Journals the named entries of the shared stats; without any, writes a full checkpoint."""
+    if not (users or events or admin_logs or keys):
+        STATS_STORE.checkpoint(stats); return
+    record_for = lambda user_id: stats["users"][user_id].to_json() if user_id in stats["users"] else None
+    changes = [("user", user_id, record_for(user_id)) for user_id in users]
+    changes += [("event", name, stats["events"].get(name)) for name in events]
+    changes += [("admin_log", user_id, stats["admin_logs"].get(user_id)) for user_id in admin_logs]
+    changes += [("key", key, stats.get(key)) for key in keys]
+    STATS_STORE.commit(changes)
+
+async def checkpoint_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    if STATS_STORE.journal and STATS_STORE.journal.size: await STATS_STORE.checkpoint_in_background()  # Nothing journaled, the file is current
 
 def ensure_user_in_stats(user_id: int, stats: dict) -> dict:
     user_id_str = str(user_id)
     if user_id_str not in stats.get("users", {}):
-        stats.setdefault("users", {})[user_id_str] = {
-            "first_start": datetime.now().isoformat(),
-            "last_start": datetime.now().isoformat(),
-            "discount_sent": False,
-            "preview_clicks": 0,
-            "payments_initiated": [],
-            "banned": False,
-            "paypal_offer_sent": False
-        }
-        save_stats(stats)
+        # Users archived by the stats maintenance come back with their history and discounts
+        stats.setdefault("users", {})[user_id_str] = STATS_ARCHIVE.restore(user_id_str) or UserRecord.new()
+        save_stats(stats, users=[user_id_str])
     return stats
 
 async def save_discounts_to_telegram(context: ContextTypes.DEFAULT_TYPE):
     if not NOTIFICATION_GROUP_ID: return
     stats = load_stats(); discounts_to_save = {}
-    for user_id, user_data in stats.get("users", {}).items():
-        if "discounts" in user_data: discounts_to_save[user_id] = user_data["discounts"]
+    for user_id, record in stats.get("users", {}).items():
+        if record.discounts is not None: discounts_to_save[user_id] = record.discounts
     json_string = json.dumps(discounts_to_save, indent=2); message_text = f"{DISCOUNT_MSG_HEADER}\n<tg-spoiler>{json_string}</tg-spoiler>"; discount_message_id = stats.get("discount_message_id")
     try:
         if discount_message_id: await context.bot.edit_message_text(chat_id=NOTIFICATION_GROUP_ID, message_id=discount_message_id, text=message_text, parse_mode='HTML')
@@ -216,30 +629,34 @@ async def save_discounts_to_telegram(context: ContextTypes.DEFAULT_TYPE):
         logger.warning("Discount message not found or invalid, creating a new one.")
         try:
             sent_message = await context.bot.send_message(chat_id=NOTIFICATION_GROUP_ID, text=message_text, parse_mode='HTML')
-            stats["discount_message_id"] = sent_message.message_id; save_stats(stats)
+            stats["discount_message_id"] = sent_message.message_id; save_stats(stats, keys=["discount_message_id"])
         except Exception as e: logger.error(f"Could not create a new discount persistence message: {e}")
 
 async def load_discounts_from_telegram(application: Application):
     if not NOTIFICATION_GROUP_ID: return
     try:
-        stats = load_stats()
-        discount_message_id = stats.get("discount_message_id")
+        discount_message_id = load_stats().get("discount_message_id")
         if not discount_message_id: return
         message = await application.bot.get_message(chat_id=NOTIFICATION_GROUP_ID, message_id=discount_message_id)
         json_match = re.search(r'<tg-spoiler>(.*)</tg-spoiler>', message.text_html, re.DOTALL)
         if not json_match: return
-        discounts_data = json.loads(json_match.group(1)); users_updated = 0
+        discounts_data = json.loads(json_match.group(1)); users_updated = []
+        # Reload after the network round-trip so updates handled in the meantime are not overwritten
+        stats = load_stats()
         for user_id, discounts in discounts_data.items():
-            if user_id in stats["users"]: stats["users"][user_id]["discounts"] = discounts; users_updated += 1
-        if users_updated > 0: save_stats(stats); logger.info(f"Successfully restored discounts for {users_updated} users.")
+            if user_id in stats["users"]: stats["users"][user_id].discounts = discounts; users_updated.append(user_id)
+        if users_updated: save_stats(stats, users=users_updated); logger.info(f"Successfully restored discounts for {len(users_updated)} users.")
     except Exception as e: logger.error(f"An unexpected error occurred during discount restore: {e}")
 
+async def restore_discounts_job(context: ContextTypes.DEFAULT_TYPE):
+    await load_discounts_from_telegram(context.application)
+
 async def track_event(event_name: str, context: ContextTypes.DEFAULT_TYPE, user_id: int):
     if str(user_id) == ADMIN_USER_ID: return
-    stats = load_stats(); stats["events"][event_name] = stats["events"].get(event_name, 0) + 1; save_stats(stats)
+    stats = load_stats(); stats["events"][event_name] = stats["events"].get(event_name, 0) + 1; save_stats(stats, events=[event_name])
 
 def is_user_banned(user_id: int) -> bool:
-    stats = load_stats(); user_data = stats.get("users", {}).get(str(user_id), {}); return user_data.get("banned", False)
+    stats = load_stats(); record = stats.get("users", {}).get(str(user_id)); return bool(record and record.banned)
 
 def get_discounted_price(base_price: int, discount_data: dict, package_key: str) -> int:
     if not discount_data: return -1
@@ -255,8 +672,46 @@ def get_discounted_price(base_price: int, discount_data: dict, package_key: str)
         if package_key in packages: value = packages[package_key]; new_price = base_price * (1 - value / 100); return ceil(new_price)
     return -1
 
-def get_package_button_text(media_type: str, amount: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> str:
-    stats = load_stats(); user_data = stats.get("users", {}).get(str(user_id), {}); base_price = PRICES[media_type][amount]; package_key = f"{media_type}_{amount}"
+@dataclass(frozen=True, slots=True)
+class PackagePrice:
+    base: int
+    price: int  # Amount to pay: discounted for picture/video packages, the deposit for meetings
+    discounted: bool = False
+
+def discount_profile_key(discount_data: dict | None) -> tuple:
+    """Hashable form of the fields of a discount dict that affect prices."""
+    if not discount_data: return ()
+    packages = discount_data.get("packages")
+    return (discount_data.get("type"), discount_data.get("value", 0), tuple(sorted(packages.items())) if packages else ())
+
+@lru_cache(maxsize=1024)
+def _compile_price_matrix(profile_key: tuple) -> MappingProxyType:
+    discount_data = {"type": profile_key[0], "value": profile_key[1], "packages": dict(profile_key[2])} if profile_key else None
+    matrix = {}
+    for media_type, prices in PRICES.items():
+        for amount, base_price in prices.items():
+            if media_type == "livecall": entry = PackagePrice(base_price, base_price)
+            elif media_type == "treffen": entry = PackagePrice(base_price, ceil(base_price / 4))
+            else:
+                discount_price = get_discounted_price(base_price, discount_data, f"{media_type}_{amount}")
+                entry = PackagePrice(base_price, base_price) if discount_price == -1 else PackagePrice(base_price, discount_price, True)
+            matrix[(media_type, amount)] = entry
+    return MappingProxyType(matrix)
+
+def get_price_matrix(discount_data: dict | None) -> MappingProxyType:
+    """Returns the immutable (media_type, amount) -> PackagePrice table for a discount profile."""
+    if not discount_data: return _compile_price_matrix(())
+    return _compile_price_matrix(discount_profile_key(discount_data))
+
+def get_package_price(media_type: str, amount: int, discount_data: dict | None = None) -> PackagePrice:
+    return get_price_matrix(discount_data)[(media_type, amount)]
+
+def get_user_price_matrix(user_id: int) -> MappingProxyType:
+    record = load_stats().get("users", {}).get(str(user_id)); return get_price_matrix(record.discounts if record else None)
+
+def get_package_button_text(media_type: str, amount: int, user_id: int, context: ContextTypes.DEFAULT_TYPE, price_matrix: MappingProxyType | None = None) -> str:
+    if price_matrix is None: price_matrix = get_user_price_matrix(user_id)
+    package_price = price_matrix[(media_type, amount)]
 
     duration_text = ""
     if media_type == "livecall":
@@ -272,52 +727,106 @@ def get_package_button_text(media_type: str, amount: int, user_id: int, context:
         key = f"package_button_text_{media_type.lower()}"
         duration_text = get_text(key, context, amount=amount)
 
-    if media_type not in ["livecall", "treffen"]:
-        discount_price = get_discounted_price(base_price, user_data.get("discounts"), package_key)
-        if discount_price != -1:
-            return f"{duration_text} ~{base_price}~{discount_price}€ ✨"
+    if package_price.discounted:
+        return f"{duration_text} ~{package_price.base}~{package_price.price}€ ✨"
 
-    return f"{duration_text} {base_price}€"
+    return f"{duration_text} {package_price.base}€"
 
 async def check_user_status(user_id: int, context: ContextTypes.DEFAULT_TYPE):
     if str(user_id) == ADMIN_USER_ID: return "admin", False, None
     stats = load_stats()
     user_id_str = str(user_id)
-    now = datetime.now()
+    now = int(time.time())
 
     if user_id_str not in stats.get("users", {}):
+        archived = user_id_str in STATS_ARCHIVE
         stats = ensure_user_in_stats(user_id, stats)
-        return "new", True, stats["users"][user_id_str]
-
-    user_data = stats["users"][user_id_str]
-    last_start_dt = datetime.fromisoformat(user_data.get("last_start"))
-
-    if now - last_start_dt > timedelta(hours=24):
-        return "returning", True, user_data
-
-    return "active", False, user_data
+        if not archived: return "new", True, stats["users"][user_id_str]
+
+    record = stats["users"][user_id_str]
+
+    if now - record.last_start > 24 * 3600:
+        return "returning", True, record
+
+    return "active", False, record
+
+# --- Admin Log Rendering ---
+ADMIN_LOG_CACHE_SIZE = 5000
+
+@dataclass(slots=True)
+class AdminLogRender:
+    """Last rendered admin log of a user; each block is only rebuilt when its inputs change."""
+    header_key: tuple = ()
+    header: str = ""
+    payments_key: tuple = ()
+    payments: str = ""
+    message_id: int | None = None
+    digest: bytes = b""  # Hash of the text last shown in message_id
+
+ADMIN_LOG_RENDERS: OrderedDict[str, AdminLogRender] = OrderedDict()
+
+def get_admin_log_render(user_id_str: str) -> AdminLogRender:
+    render = ADMIN_LOG_RENDERS.get(user_id_str)
+    if render is None:
+        render = ADMIN_LOG_RENDERS[user_id_str] = AdminLogRender()
+        if len(ADMIN_LOG_RENDERS) > ADMIN_LOG_CACHE_SIZE: ADMIN_LOG_RENDERS.popitem(last=False)
+    else: ADMIN_LOG_RENDERS.move_to_end(user_id_str)
+    return render
+
+def render_admin_log(render: AdminLogRender, user: User, record: UserRecord, event_text: str) -> str:
+    header_key = (user.first_name, record.discount_sent or record.discounts is not None, record.banned, record.first_start, record.preview_clicks)
+    if header_key != render.header_key:
+        user_mention = f"[{escape_markdown(user.first_name, version=2)}](tg://user?id={user.id})"; discount_emoji = "💸" if header_key[1] else ""; banned_emoji = "🚫" if record.banned else ""
+        first_start_str = "N/A"
+        if record.first_start: first_start_str = datetime.fromtimestamp(record.first_start).strftime('%Y-%m-%d %H:%M')
+        render.header = (f"👤 *Nutzer-Aktivität* {discount_emoji}{banned_emoji}\n\n" f"*Nutzer:* {user_mention} (`{user.id}`)\n" f"*Erster Start:* `{first_start_str}`\n\n" f"🖼️ *Vorschau-Klicks:* {record.preview_clicks}/25\n\n")
+        render.header_key = header_key
+    payments = record.payments; payments_key = (len(payments), payments[-1] if payments else None)  # Payments are append-only, trimmed from the front
+    if payments_key != render.payments_key:
+        render.payments = "\n".join(f"   • {p}" for p in payments) if payments else "   • Keine"; render.payments_key = payments_key
+    return f"{render.header}💰 *Bezahlversuche*\n{render.payments}\n\n`Letzte Aktion: {event_text}`".strip()
 
 async def send_or_update_admin_log(context: ContextTypes.DEFAULT_TYPE, user: User, event_text: str = ""):
     if not NOTIFICATION_GROUP_ID or str(user.id) == ADMIN_USER_ID: return
+    user_id_str = str(user.id); render = get_admin_log_render(user_id_str)
     try:
-        user_id_str = str(user.id); stats = load_stats(); admin_logs = stats.get("admin_logs", {}); user_data = stats.get("users", {}).get(user_id_str, {}); log_message_id = admin_logs.get(user_id_str, {}).get("message_id")
-        user_mention = f"[{escape_markdown(user.first_name, version=2)}](tg://user?id={user.id})"; discount_emoji = "💸" if user_data.get("discount_sent") or "discounts" in user_data else ""; banned_emoji = "🚫" if user_data.get("banned") else ""
-        first_start_str = "N/A"
-        if user_data.get("first_start"): first_start_str = datetime.fromisoformat(user_data["first_start"]).strftime('%Y-%m-%d %H:%M')
-        preview_clicks = user_data.get("preview_clicks", 0); payments = user_data.get("payments_initiated", []); payments_str = "\n".join(f"   • {p}" for p in payments) if payments else "   • Keine"
-        base_text = (f"👤 *Nutzer-Aktivität* {discount_emoji}{banned_emoji}\n\n" f"*Nutzer:* {user_mention} (`{user.id}`)\n" f"*Erster Start:* `{first_start_str}`\n\n" f"🖼️ *Vorschau-Klicks:* {preview_clicks}/25\n\n" f"💰 *Bezahlversuche*\n{payments_str}")
-        final_text = f"{base_text}\n\n`Letzte Aktion: {event_text}`".strip()
+        stats = load_stats(); admin_logs = stats.get("admin_logs", {}); record = stats.get("users", {}).get(user_id_str) or UserRecord(); log_message_id = admin_logs.get(user_id_str, {}).get("message_id")
+        final_text = render_admin_log(render, user, record, event_text); digest = hashlib.blake2b(final_text.encode(), digest_size=16).digest()
+        if log_message_id and render.message_id == log_message_id and render.digest == digest: return  # Identical edit, Telegram would only answer "not modified"
         if log_message_id: await context.bot.edit_message_text(chat_id=NOTIFICATION_GROUP_ID, message_id=log_message_id, text=final_text, parse_mode='Markdown')
         else:
             sent_message = await context.bot.send_message(chat_id=NOTIFICATION_GROUP_ID, text=final_text, parse_mode='Markdown')
-            admin_logs.setdefault(user_id_str, {})["message_id"] = sent_message.message_id; stats["admin_logs"] = admin_logs; save_stats(stats)
+            log_message_id = sent_message.message_id
+            admin_logs.setdefault(user_id_str, {})["message_id"] = log_message_id; stats["admin_logs"] = admin_logs; save_stats(stats, admin_logs=[user_id_str])
+        render.message_id = log_message_id; render.digest = digest
     except error.BadRequest as e:
+        render.digest = b""
         if "chat not found" in str(e).lower(): logger.warning(f"Admin log group '{NOTIFICATION_GROUP_ID}' not found.")
         elif "message to edit not found" in str(e): logger.warning(f"Admin log for user {user.id} not found.")
+        elif "message is not modified" in str(e): render.message_id = log_message_id; render.digest = digest
         else: logger.error(f"BadRequest on admin log for user {user.id}: {e}")
     except error.TelegramError as e:
+        render.digest = b""
         if 'message is not modified' not in str(e): logger.warning(f"Temporary error updating admin log for user {user.id}: {e}")
 
+# Admin logs are posted in the background: the group allows few messages per minute, and a user's reply must
+# never wait for them. Events that arrive while a user's log is still being posted collapse into the latest one.
+ADMIN_LOG_QUEUED = {}  # user id -> (user, event_text) not yet posted
+ADMIN_LOG_WORKERS = set()
+
+def log_admin_event(context: ContextTypes.DEFAULT_TYPE, user: User, event_text: str = ""):
+    if not NOTIFICATION_GROUP_ID or str(user.id) == ADMIN_USER_ID: return
+    user_id_str = str(user.id); ADMIN_LOG_QUEUED[user_id_str] = (user, event_text)
+    if user_id_str not in ADMIN_LOG_WORKERS:
+        ADMIN_LOG_WORKERS.add(user_id_str); context.application.create_task(post_queued_admin_logs(context, user_id_str))
+
+async def post_queued_admin_logs(context: ContextTypes.DEFAULT_TYPE, user_id_str: str):
+    try:
+        while user_id_str in ADMIN_LOG_QUEUED:
+            user, event_text = ADMIN_LOG_QUEUED.pop(user_id_str)
+            await send_or_update_admin_log(context, user, event_text=event_text)
+    finally: ADMIN_LOG_WORKERS.discard(user_id_str)
+
 def get_media_files(media_type: str, purpose: str) -> list:
     matching_files = []
     if media_type == 'combined' and purpose == 'vorschau':
@@ -336,6 +845,108 @@ def get_media_files(media_type: str, purpose: str) -> list:
     matching_files.sort()
     return matching_files
 
+# --- Conversation States ---
+# A user waiting for text input has one pending state in user_data: awaiting_input (the state key used for
+# dispatch), awaiting_payload and awaiting_token. States left unanswered expire via a timer wheel.
+class TimerWheel:
+    """Hashed timing wheel: scheduling is O(1) and advancing only visits the slots of the ticks that passed."""
+
+    def __init__(self, tick: float, slots: int):
+        self.tick = tick; self.slots = [[] for _ in range(slots)]
+        self.current = int(time.monotonic() // tick)
+
+    def __len__(self) -> int:
+        return sum(len(slot) for slot in self.slots)
+
+    def schedule(self, delay: float, item):
+        deadline = max(self.current + 1, ceil((time.monotonic() + delay) / self.tick))
+        self.slots[deadline % len(self.slots)].append((deadline, item))
+
+    def advance(self, now: float | None = None) -> list:
+        """Returns the items that are due, removing them from the wheel."""
+        target = int((time.monotonic() if now is None else now) // self.tick); expired = []
+        # After a pause longer than one round every slot is due for a visit, but only once
+        for tick in range(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot: continue
+            expired += [item for deadline, item in slot if deadline <= target]
+            slot[:] = [entry for entry in slot if entry[0] > target]  # Entries for a later round stay
+        self.current = max(self.current, target)
+        return expired
+
+CONVERSATION_STATES = TimerWheel(CONVERSATION_STATE_TICK, CONVERSATION_STATE_SLOTS)
+_state_tokens = itertools.count(1)
+
+def set_awaiting_input(context: ContextTypes.DEFAULT_TYPE, state: str, payload=None):
+    token = next(_state_tokens)
+    context.user_data.update(awaiting_input=state, awaiting_payload=payload, awaiting_token=token)
+    CONVERSATION_STATES.schedule(CONVERSATION_STATE_TIMEOUT.total_seconds(), (context.user_data, token))
+
+def clear_awaiting_input(user_data: dict):
+    """Drops the pending state and returns its payload."""
+    user_data.pop('awaiting_input', None); user_data.pop('awaiting_token', None)
+    return user_data.pop('awaiting_payload', None)
+
+async def expire_conversation_states_job(context: ContextTypes.DEFAULT_TYPE):
+    expired = 0
+    for user_data, token in CONVERSATION_STATES.advance():
+        if user_data.get('awaiting_token') != token: continue  # Answered or replaced by a newer state
+        if user_data.get('awaiting_input', '').startswith('treffen_'): user_data.pop('treffen_buchung', None)
+        clear_awaiting_input(user_data); expired += 1
+    if expired: logger.info(f"Expired {expired} unanswered conversation states.")
+
+# --- Media File ID Cache ---
+class MediaCache:
+    """Telegram file_ids of already uploaded media, keyed by path and invalidated when the file changes."""
+
+    def __init__(self):
+        self.path = None; self.entries = {}
+
+    def load(self) -> dict:
+        if self.path != MEDIA_CACHE_FILE:
+            self.path = MEDIA_CACHE_FILE
+            try:
+                with open(MEDIA_CACHE_FILE, "r") as f: self.entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError): self.entries = {}
+        return self.entries
+
+    @staticmethod
+    def fingerprint(media_path: str) -> list:
+        st = os.stat(media_path); return [st.st_size, st.st_mtime_ns]
+
+    def get(self, media_path: str) -> str | None:
+        entry = self.load().get(media_path)
+        try: return entry["file_id"] if entry and entry["fingerprint"] == self.fingerprint(media_path) else None
+        except OSError: return None
+
+    def remember(self, pairs: list):
+        """Stores the file_ids of sent messages; pairs are (media_path, message)."""
+        entries = self.load(); changed = False
+        for media_path, message in pairs:
+            file_id = message_file_id(message)
+            if not file_id or (media_path in entries and entries[media_path]["file_id"] == file_id): continue
+            try: entries[media_path] = {"file_id": file_id, "fingerprint": self.fingerprint(media_path)}; changed = True
+            except OSError: continue
+        if changed: write_json_atomic(MEDIA_CACHE_FILE, entries)
+
+    def forget(self, media_path: str):
+        if self.load().pop(media_path, None): write_json_atomic(MEDIA_CACHE_FILE, self.entries)
+
+MEDIA_CACHE = MediaCache()
+
+def is_video_path(media_path: str) -> bool:
+    return media_path.lower().endswith(VIDEO_EXTENSIONS)
+
+def message_file_id(message) -> str | None:
+    if message is None: return None
+    if message.video: return message.video.file_id
+    if message.photo: return message.photo[-1].file_id
+    return None
+
+def input_media(media_path: str, stack: contextlib.ExitStack):
+    """Cached file_id if there is one, otherwise the opened file (closed together with ``stack``)."""
+    return MEDIA_CACHE.get(media_path) or stack.enter_context(open(media_path, 'rb'))
+
 async def cleanup_bot_messages(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     if 'tracked_message_ids' in context.chat_data:
         message_ids = context.chat_data['tracked_message_ids']
@@ -385,34 +996,63 @@ async def query_or_message_edit(update: Update, context: ContextTypes.DEFAULT_TY
         await send_tracked_message(context, chat_id=update.effective_chat.id, text=text, **kwargs)
 
 
-async def send_preview_message(update: Update, context: ContextTypes.DEFAULT_TYPE, media_type: str, start_index: int = 0):
+async def send_preview_album(context: ContextTypes.DEFAULT_TYPE, chat_id: int, media_paths: list, start_index: int, album_size: int, stack: contextlib.ExitStack):
+    """Sends up to album_size previews from start_index (wrapping around) as one media group and returns how many were sent."""
+    album_paths = [media_paths[(start_index + i) % len(media_paths)] for i in range(min(album_size, len(media_paths), PREVIEW_ALBUM_SIZE))]
+    album = [InputMediaVideo(media=input_media(path, stack), supports_streaming=True) if is_video_path(path) else InputMediaPhoto(media=input_media(path, stack)) for path in album_paths]
+    messages = await context.bot.send_media_group(chat_id=chat_id, media=album, protect_content=True)
+    for message in messages: track_message(context, message.message_id)
+    MEDIA_CACHE.remember(list(zip(album_paths, messages)))
+    context.user_data['preview_album_size'] = len(album_paths)
+    return len(messages)
+
+def preview_album_size(record: UserRecord, first_album: bool) -> int:
+    """How many previews the next album may hold; like in single mode, the first medium shown is free.
+
+    Below 2 (Telegram's minimum for a media group), send_preview_message sends a single medium instead.
+    """
+    return max(0, min(PREVIEW_ALBUM_SIZE, PREVIEW_CLICK_LIMIT - record.preview_clicks + first_album))
+
+async def send_preview_message(update: Update, context: ContextTypes.DEFAULT_TYPE, media_type: str, start_index: int = 0, album_size: int = PREVIEW_ALBUM_SIZE, media_paths: list = None):
+    """Shows the preview at start_index and returns how many media were sent.
+
+    Pass the session's gallery as media_paths to keep its order instead of starting a new one.
+    """
     chat_id = update.effective_chat.id
     await cleanup_bot_messages(chat_id, context)
 
-    media_paths = get_media_files(media_type, "vorschau")
-    if media_type == 'combined': random.shuffle(media_paths)
+    if media_paths is None:
+        media_paths = get_media_files(media_type, "vorschau")
+        if media_type == 'combined': random.shuffle(media_paths)
     context.user_data['preview_gallery'] = media_paths
+    context.user_data.pop('preview_album_size', None)
 
     if not media_paths:
         text = get_text("no_preview_content", context)
         keyboard = [[InlineKeyboardButton(get_text("back_button", context), callback_data="main_menu")]]
         await send_tracked_message(context, chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+        return 0
 
     start_index %= len(media_paths)
     context.user_data[f'preview_index_{media_type}'] = start_index
     media_path = media_paths[start_index]
     file_extension = os.path.splitext(media_path)[1].lower()
 
+    sent = 0
     try:
-        with open(media_path, 'rb') as media_file:
-            media_message = None
-            if file_extension in ['.jpg', '.jpeg', '.png']:
-                media_message = await send_tracked_photo(context, chat_id=chat_id, photo=media_file, protect_content=True)
-            elif file_extension in ['.mp4', '.mov', '.m4v']:
-                media_message = await send_tracked_video(context, chat_id=chat_id, video=media_file, protect_content=True, supports_streaming=True)
-            if media_message:
-                context.chat_data['media_message_id'] = media_message.message_id
+        with contextlib.ExitStack() as stack:
+            if PREVIEW_ALBUM_MODE and min(album_size, len(media_paths)) >= 2:
+                sent = await send_preview_album(context, chat_id, media_paths, start_index, album_size, stack)
+            else:
+                media_message = None
+                if file_extension in PHOTO_EXTENSIONS:
+                    media_message = await send_tracked_photo(context, chat_id=chat_id, photo=input_media(media_path, stack), protect_content=True)
+                elif file_extension in VIDEO_EXTENSIONS:
+                    media_message = await send_tracked_video(context, chat_id=chat_id, video=input_media(media_path, stack), protect_content=True, supports_streaming=True)
+                if media_message:
+                    sent = 1; context.chat_data['media_message_id'] = media_message.message_id
+                    context.user_data['preview_album_size'] = 1  # Album mode advances past it like a one-item album
+                    MEDIA_CACHE.remember([(media_path, media_message)])
 
         caption = get_text("preview_caption", context, age_anna=AGE_ANNA)
         keyboard = [
@@ -424,7 +1064,10 @@ async def send_preview_message(update: Update, context: ContextTypes.DEFAULT_TYP
         ]
         await send_tracked_message(context, chat_id=chat_id, text=caption, reply_markup=InlineKeyboardMarkup(keyboard))
     except error.TelegramError as e:
+        if "file identifier" in str(e).lower():
+            for path in media_paths: MEDIA_CACHE.forget(path)  # Stale file_ids, the next send uploads again
         logger.error(f"Error sending preview file {media_path}: {e}")
+    return sent
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
@@ -449,15 +1092,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     try:
-        status, should_notify, user_data = await check_user_status(user.id, context)
+        status, should_notify, record = await check_user_status(user.id, context)
         await track_event("start_command", context, user.id)
-        if user_data and not user_data.get("discount_sent"):
-            last_start_dt = datetime.fromisoformat(user_data.get("last_start"))
-            if datetime.now() - last_start_dt > timedelta(hours=2):
+        if record and not record.discount_sent:
+            if time.time() - record.last_start > 2 * 3600:
                 stats = load_stats()
-                stats["users"][str(user.id)]["discounts"] = {"type": "percent", "value": 10}
-                stats["users"][str(user.id)]["discount_sent"] = True
-                save_stats(stats)
+                stats["users"][str(user.id)].discounts = {"type": "percent", "value": 10}
+                stats["users"][str(user.id)].discount_sent = True
+                save_stats(stats, users=[str(user.id)])
                 await save_discounts_to_telegram(context)
                 discount_text = get_text("discount_offer_text", context)
                 keyboard = [[InlineKeyboardButton(get_text("discount_offer_button", context), callback_data="show_price_options")]]
@@ -465,14 +1107,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 return
         if should_notify:
             event_text = "Bot gestartet (neuer Nutzer)" if status == "new" else "Bot erneut gestartet"
-            await send_or_update_admin_log(context, user, event_text=event_text)
+            log_admin_event(context, user, event_text=event_text)
     except Exception as e:
         logger.error(f"Error in start logic for user {user.id}: {e}")
 
     stats = load_stats()
     ensure_user_in_stats(user.id, stats)
-    stats["users"][str(user.id)]["last_start"] = datetime.now().isoformat()
-    save_stats(stats)
+    stats["users"][str(user.id)].last_start = int(time.time())
+    save_stats(stats, users=[str(user.id)])
 
     welcome_text = get_text("welcome_text", context)
     keyboard = [
@@ -491,7 +1133,7 @@ async def show_prices_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await cleanup_bot_messages(chat_id, context)
         await track_event("prices_viewed", context, user.id)
-        await send_or_update_admin_log(context, user, event_text="Schaut sich die Preise an")
+        log_admin_event(context, user, event_text="Schaut sich die Preise an")
 
         caption = get_text("select_package_caption", context)
         keyboard = get_price_keyboard(user.id, context)
@@ -501,8 +1143,9 @@ async def show_prices_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if media_paths:
             random_media_path = random.choice(media_paths)
             try:
-                with open(random_media_path, 'rb') as media_file:
-                    await send_tracked_video(context, chat_id=chat_id, video=media_file, caption=caption, reply_markup=InlineKeyboardMarkup(keyboard), protect_content=True, supports_streaming=True)
+                with contextlib.ExitStack() as stack:
+                    message = await send_tracked_video(context, chat_id=chat_id, video=input_media(random_media_path, stack), caption=caption, reply_markup=InlineKeyboardMarkup(keyboard), protect_content=True, supports_streaming=True)
+                MEDIA_CACHE.remember([(random_media_path, message)])
                 return
             except Exception as e_video:
                 logger.error(f"Could not send price video {random_media_path}, falling back to text: {e_video}")
@@ -530,8 +1173,9 @@ async def show_treffen_summary(update: Update, context: ContextTypes.DEFAULT_TYP
 
     duration = buchung['duration']
     duration_text = get_package_button_text('treffen', duration, user.id, context).split(' ')[0]
-    full_price = PRICES['treffen'][duration]
-    deposit = ceil(full_price / 4)
+    package_price = get_package_price('treffen', duration)
+    full_price = package_price.base
+    deposit = package_price.price
     cash_price = full_price * 0.9
     
     summary_text = get_text("meeting_summary_title", context)
@@ -554,12 +1198,13 @@ async def show_treffen_summary(update: Update, context: ContextTypes.DEFAULT_TYP
     await send_tracked_message(context, chat_id=chat_id, text=summary_text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
 def get_price_keyboard(user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    return [
-        [InlineKeyboardButton(get_package_button_text("bilder", 10, user_id, context), callback_data="select_package:bilder:10"), InlineKeyboardButton(get_package_button_text("videos", 10, user_id, context), callback_data="select_package:videos:10")],
-        [InlineKeyboardButton(get_package_button_text("bilder", 25, user_id, context), callback_data="select_package:bilder:25"), InlineKeyboardButton(get_package_button_text("videos", 25, user_id, context), callback_data="select_package:videos:25")],
-        [InlineKeyboardButton(get_package_button_text("bilder", 35, user_id, context), callback_data="select_package:bilder:35"), InlineKeyboardButton(get_package_button_text("videos", 35, user_id, context), callback_data="select_package:videos:35")],
-        [InlineKeyboardButton(get_text("main_menu_button", context), callback_data="main_menu")]
+    price_matrix = get_user_price_matrix(user_id)
+    keyboard = [
+        [InlineKeyboardButton(get_package_button_text(media_type, amount, user_id, context, price_matrix), callback_data=f"select_package:{media_type}:{amount}") for media_type in ("bilder", "videos")]
+        for amount in (10, 25, 35)
     ]
+    keyboard.append([InlineKeyboardButton(get_text("main_menu_button", context), callback_data="main_menu")])
+    return keyboard
     
 # --- Admin Menu Functions (remains in German for the admin) ---
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -569,11 +1214,12 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await show_admin_menu(update, context)
 
 async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = "🔒 *Admin-Menü*\n\nWähle eine Option:"
+    text = "🔒 *Admin-Menü*\n\n" + "\n".join(LOOP_MONITOR.summary_lines()) + "\n\nWähle eine Option:"
     keyboard = [
         [InlineKeyboardButton("📊 Nutzer-Statistiken", callback_data="admin_stats_users"), InlineKeyboardButton("🖱️ Klick-Statistiken", callback_data="admin_stats_clicks")],
         [InlineKeyboardButton("🎟️ Gutscheine", callback_data="admin_show_vouchers")],
-        [InlineKeyboardButton("👤 Nutzer verwalten", callback_data="admin_user_manage")]
+        [InlineKeyboardButton("👤 Nutzer verwalten", callback_data="admin_user_manage")],
+        [InlineKeyboardButton("🧹 Wartung jetzt ausführen", callback_data="admin_run_maintenance")]
     ]
     await query_or_message_edit(update, context, text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
@@ -587,6 +1233,15 @@ async def show_user_management_menu(update: Update, context: ContextTypes.DEFAUL
     ]
     await query_or_message_edit(update, context, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
+def build_vouchers_pdf(vouchers: dict) -> BytesIO:
+    from fpdf import FPDF  # Lazy import: only needed for this rarely used admin export
+    pdf = FPDF(); pdf.add_page(); pdf.set_font("Helvetica", size=12)
+    pdf.cell(0, 10, "Amazon Gutschein Report", new_x="LMARGIN", new_y="NEXT", align='C')
+    if vouchers.get("amazon"):
+        for code in vouchers["amazon"]: pdf.cell(0, 8, f"- {code.encode('latin-1', 'ignore').decode('latin-1')}", new_x="LMARGIN", new_y="NEXT")
+    else: pdf.cell(0, 8, "Keine Gutscheine vorhanden.", new_x="LMARGIN", new_y="NEXT")
+    return BytesIO(pdf.output())  # fpdf2 returns the document as a bytearray
+
 async def show_vouchers_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     vouchers = load_vouchers()
     amazon_codes = "\n".join([f"- `{code}`" for code in vouchers.get("amazon", [])]) or "Keine"
@@ -597,6 +1252,94 @@ async def show_vouchers_panel(update: Update, context: ContextTypes.DEFAULT_TYPE
     ]
     await query_or_message_edit(update, context, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
+USERS_PAGE_SIZE = 10
+
+def format_user_line(user_id: str, record: UserRecord) -> str:
+    flags = ("🚫" if record.banned else "") + ("💸" if record.discount_sent or record.discounts is not None else "")
+    last_start = datetime.fromtimestamp(record.last_start).strftime('%d.%m.%y %H:%M') if record.last_start else "N/A"
+    return f"`{user_id}` {flags}\n   Zuletzt: {last_start} | Klicks: {record.preview_clicks} | Zahlungen: {len(record.payments)}"
+
+async def show_users_overview(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_count = len(load_stats()["users"])
+    text = f"📊 *Nutzer-Statistiken*\n\nGesamtzahl der Nutzer: {user_count}"
+    keyboard = [
+        [InlineKeyboardButton("👥 Nutzer durchsuchen", callback_data="admin_users_page:0")],
+        [InlineKeyboardButton("📄 Export CSV", callback_data="admin_export_users:csv"), InlineKeyboardButton("📄 Export JSONL", callback_data="admin_export_users:jsonl")],
+        [InlineKeyboardButton("« Zurück", callback_data="admin_main_menu")]
+    ]
+    await query_or_message_edit(update, context, text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def show_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int):
+    start_index = page * USERS_PAGE_SIZE
+    entries = list(itertools.islice(load_stats()["users"].items(), start_index, start_index + USERS_PAGE_SIZE + 1))
+    has_next = len(entries) > USERS_PAGE_SIZE
+    lines = [format_user_line(user_id, record) for user_id, record in entries[:USERS_PAGE_SIZE]]
+    text = f"👥 *Nutzer (Seite {page + 1})*\n\n" + ("\n".join(lines) if lines else "Keine Nutzer auf dieser Seite.")
+    navigation = []
+    if page > 0: navigation.append(InlineKeyboardButton("« Vorherige", callback_data=f"admin_users_page:{page - 1}"))
+    if has_next: navigation.append(InlineKeyboardButton("Nächste »", callback_data=f"admin_users_page:{page + 1}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("« Zurück", callback_data="admin_stats_users")])
+    await query_or_message_edit(update, context, text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+# --- User Export ---
+USER_EXPORT_FIELDS = ["user_id", "first_start", "last_start", "banned", "discount_sent", "paypal_offer_sent", "preview_clicks", "payments", "discounts"]
+
+def iter_user_export_rows(users):
+    for user_id, record in users:
+        yield {
+            "user_id": user_id,
+            "first_start": datetime.fromtimestamp(record.first_start).isoformat() if record.first_start else "",
+            "last_start": datetime.fromtimestamp(record.last_start).isoformat() if record.last_start else "",
+            "banned": record.banned, "discount_sent": record.discount_sent, "paypal_offer_sent": record.paypal_offer_sent,
+            "preview_clicks": record.preview_clicks,
+            "payments": [str(p) for p in record.payments],
+            "discounts": record.discounts,
+        }
+
+class _LineBuffer(list):
+    write = list.append
+
+def iter_csv_lines(rows, fieldnames: list):
+    buffer = _LineBuffer()
+    writer = csv.writer(buffer)
+    writer.writerow(fieldnames)
+    for row in rows:
+        writer.writerow([json.dumps(row[name], ensure_ascii=False) if isinstance(row[name], (list, dict)) else row[name] for name in fieldnames])
+        yield from buffer; buffer.clear()
+    yield from buffer
+
+def iter_jsonl_lines(rows):
+    for row in rows: yield json.dumps(row, ensure_ascii=False) + "\n"
+
+def write_user_export(export_format: str, users: list, events: list):
+    """Streams (user id, record) and (event, count) pairs into two temporary files, line by line."""
+    if export_format == "csv":
+        sections = [("users", iter_csv_lines(iter_user_export_rows(users), USER_EXPORT_FIELDS)),
+                    ("events", iter_csv_lines(({"event": name, "count": count} for name, count in events), ["event", "count"]))]
+    else:
+        sections = [("users", iter_jsonl_lines(iter_user_export_rows(users))),
+                    ("events", iter_jsonl_lines({"event": name, "count": count} for name, count in events))]
+    files = []
+    for name, lines in sections:
+        f = tempfile.TemporaryFile()
+        text_file = TextIOWrapper(f, encoding="utf-8", newline="")
+        text_file.writelines(lines); text_file.flush(); text_file.detach()
+        f.seek(0); files.append((name, f))
+    return files
+
+async def send_user_export(context: ContextTypes.DEFAULT_TYPE, chat_id: int, export_format: str):
+    try:
+        # The stats are already in memory; the thread formats a snapshot of the entries, the live dicts keep changing
+        stats = load_stats(); users = list(stats["users"].items()); events = list(stats["events"].items())
+        files = await asyncio.to_thread(write_user_export, export_format, users, events)
+        date_str = datetime.now().strftime('%Y-%m-%d')
+        for name, f in files:
+            with f: await context.bot.send_document(chat_id=chat_id, document=f, filename=f"{name}_{date_str}.{export_format}")
+    except Exception as e:
+        logger.error(f"User export ({export_format}) failed: {e}")
+        await context.bot.send_message(chat_id=chat_id, text="⚠️ Export fehlgeschlagen.")
+
 async def show_manage_discounts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = "💸 *Rabatte verwalten*\n\nHier kannst du aktive, vom Admin vergebene Rabatte einsehen und löschen."
     keyboard = [
@@ -621,7 +1364,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 
     stats = load_stats()
     ensure_user_in_stats(user.id, stats)
-    user_data = stats["users"][str(user.id)]
+    record = stats["users"][str(user.id)]
 
     if is_user_banned(user.id):
         await query.answer(get_text("banned_user_alert", context), show_alert=True)
@@ -642,23 +1385,30 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         elif data == "admin_user_manage": await show_user_management_menu(update, context)
         
         # Anzeigen von Daten
-        elif data == "admin_stats_users":
-            await query.edit_message_text(f"Gesamtzahl der Nutzer: {len(stats.get('users', {}))}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_main_menu")]]))
+        elif data == "admin_stats_users": await show_users_overview(update, context)
+        elif data.startswith("admin_users_page:"): await show_users_page(update, context, int(data.split(":")[1]))
+        elif data.startswith("admin_export_users:"):
+            export_format = "csv" if data.endswith(":csv") else "jsonl"
+            await query.edit_message_text("⏳ Export wird erstellt und gleich als Datei gesendet …", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_stats_users")]]))
+            context.application.create_task(send_user_export(context, chat_id, export_format), update=update)
         elif data == "admin_stats_clicks":
             events = stats.get("events", {})
             text = "Klick-Statistiken:\n" + "\n".join(f"- {key}: {value}" for key, value in events.items()) if events else "Noch keine Klicks erfasst."
             await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_main_menu")]]))
         elif data == "admin_show_vouchers": await show_vouchers_panel(update, context)
+        elif data == "admin_run_maintenance":
+            context.job_queue.run_once(run_stats_maintenance, when=0, name="stats_maintenance_manual")
+            await query.edit_message_text("🧹 Wartung gestartet. Der Bericht erscheint in der Admin-Gruppe.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_main_menu")]]))
 
         # Starten von Aktionen mit Texteingabe
         elif data == "admin_user_ban_start":
-            context.user_data['awaiting_user_id_for_sperren'] = True
+            set_awaiting_input(context, "admin_sperren")
             await query.edit_message_text("Bitte sende mir die numerische Nutzer-ID der Person, die du sperren möchtest.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Abbrechen", callback_data="admin_user_manage")]]))
         elif data == "admin_user_unban_start":
-            context.user_data['awaiting_user_id_for_entsperren'] = True
+            set_awaiting_input(context, "admin_entsperren")
             await query.edit_message_text("Bitte sende mir die numerische Nutzer-ID der Person, die du entsperren möchtest.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Abbrechen", callback_data="admin_user_manage")]]))
         elif data == "admin_preview_limit_start":
-            context.user_data['awaiting_user_id_for_preview_limit'] = True
+            set_awaiting_input(context, "admin_preview_limit")
             await query.edit_message_text("Bitte sende mir die Nutzer-ID, deren Vorschau-Limit du verwalten möchtest.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Abbrechen", callback_data="admin_user_manage")]]))
 
         # Ausführen von Aktionen
@@ -672,7 +1422,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             await query.edit_message_text("Bist du sicher, dass du ALLE Rabatte von ALLEN Nutzern löschen möchtest?", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Ja, alle löschen", callback_data="admin_delete_all_discounts_execute")], [InlineKeyboardButton("Abbrechen", callback_data="admin_manage_discounts")]]))
         elif data == "admin_delete_all_discounts_execute": await execute_delete_all_discounts(update, context)
         elif data == "admin_delete_user_discount_start":
-            context.user_data['awaiting_user_id_for_discount_deletion'] = True
+            set_awaiting_input(context, "admin_discount_deletion")
             await query.edit_message_text("Sende mir die Nutzer-ID, deren Rabatte du löschen möchtest.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Abbrechen", callback_data="admin_manage_discounts")]]))
         elif data.startswith("admin_delete_user_discount_execute:"):
             _, user_id_to_clear = data.split(":")
@@ -683,22 +1433,22 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     # --- USER CALLBACKS ---
     
     if data == "download_vouchers_pdf":
-        vouchers = load_vouchers(); pdf = FPDF(); pdf.add_page(); pdf.set_font("Arial", size=12)
-        pdf.cell(0, 10, "Amazon Gutschein Report", ln=True, align='C')
-        if vouchers.get("amazon"):
-            for code in vouchers["amazon"]: pdf.cell(0, 8, f"- {code.encode('latin-1', 'ignore').decode('latin-1')}", ln=True)
-        else: pdf.cell(0, 8, "Keine Gutscheine vorhanden.", ln=True)
-        pdf_buffer = BytesIO(pdf.output(dest='S').encode('latin-1')); pdf_buffer.seek(0)
+        pdf_buffer = build_vouchers_pdf(load_vouchers())
         await context.bot.send_document(chat_id=chat_id, document=pdf_buffer, filename=f"Gutschein-Report_{datetime.now().strftime('%Y-%m-%d')}.pdf")
         return
         
     if data.startswith("show_preview:"):
         _, media_type = data.split(":")
-        if user_data.get("preview_clicks", 0) >= 25:
+        if record.preview_clicks >= PREVIEW_CLICK_LIMIT:
             await query.answer(get_text("preview_limit_reached_alert", context), show_alert=True)
             return
         await track_event(f"preview_{media_type}", context, user.id)
-        await send_or_update_admin_log(context, user, event_text="Schaut sich Vorschau an")
+        log_admin_event(context, user, event_text="Schaut sich Vorschau an")
+        if PREVIEW_ALBUM_MODE:
+            album_size = preview_album_size(record, first_album=True)
+            shown = await send_preview_message(update, context, media_type, album_size=album_size)
+            if shown > 1: record.preview_clicks += shown - 1; save_stats(stats, users=[str(user.id)])
+            return
         await send_preview_message(update, context, media_type)
         return
 
@@ -726,7 +1476,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         keyboard = []
         row = []
         for duration in sorted(PRICES['treffen'].keys()):
-            button_text = get_package_button_text('treffen', duration, user.id, context)
+            button_text = get_package_button_text('treffen', duration, user.id, context, get_price_matrix(record.discounts))
             row.append(InlineKeyboardButton(button_text, callback_data=f"select_treffen_duration:{duration}"))
             if len(row) == 2: keyboard.append(row); row = []
         if row: keyboard.append(row)
@@ -752,13 +1502,13 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         await cleanup_bot_messages(chat_id, context)
         _, duration_str = data.split(":")
         context.user_data['treffen_buchung'] = {'duration': int(duration_str)}
-        context.user_data['awaiting_input'] = 'treffen_date'
+        set_awaiting_input(context, 'treffen_date')
         text = get_text("meeting_date_prompt", context)
         await send_tracked_message(context, chat_id, text=text, parse_mode='Markdown')
         return
 
     elif data.startswith("next_preview:"):
-        if user_data.get("preview_clicks", 0) >= 25:
+        if record.preview_clicks >= PREVIEW_CLICK_LIMIT:
             await query.answer(get_text("preview_limit_reached_alert", context), show_alert=True)
             await cleanup_bot_messages(chat_id, context)
             limit_text = get_text("preview_limit_reached_text", context)
@@ -766,13 +1516,24 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             await send_tracked_message(context, chat_id, text=limit_text, reply_markup=InlineKeyboardMarkup(keyboard))
             return
 
-        stats["users"][str(user.id)]["preview_clicks"] = user_data.get("preview_clicks", 0) + 1
-        save_stats(stats)
-        await track_event("next_preview", context, user.id)
         _, media_type = data.split(":")
-        await send_or_update_admin_log(context, user, event_text=f"Nächstes Medium ({media_type})")
-
         media_paths = context.user_data.get('preview_gallery', [])
+        if PREVIEW_ALBUM_MODE and media_paths:
+            # One click per medium in the album, so the limit means the same as in single mode
+            index_key = f'preview_index_{media_type}'
+            # Advance past the last album actually sent; after a failed send the same media are tried again
+            next_index = (context.user_data.get(index_key, 0) + context.user_data.get('preview_album_size', 0)) % len(media_paths)
+            shown = await send_preview_message(update, context, media_type, start_index=next_index, album_size=preview_album_size(record, first_album=False), media_paths=media_paths)
+            if shown: record.preview_clicks += shown; save_stats(stats, users=[str(user.id)])
+            await track_event("next_preview", context, user.id)
+            log_admin_event(context, user, event_text=f"Nächstes Album ({media_type})")
+            return
+
+        record.preview_clicks += 1
+        save_stats(stats, users=[str(user.id)])
+        await track_event("next_preview", context, user.id)
+        log_admin_event(context, user, event_text=f"Nächstes Medium ({media_type})")
+
         if not media_paths: return
 
         index_key = f'preview_index_{media_type}'
@@ -783,19 +1544,20 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         media_path = media_paths[next_index]
         media_message_id = context.chat_data.get("media_message_id")
         if not media_message_id:
-            await send_preview_message(update, context, media_type, start_index=next_index)
+            await send_preview_message(update, context, media_type, start_index=next_index, media_paths=media_paths)
             return
 
         try:
-            with open(media_path, 'rb') as media_file:
-                is_video = any(media_path.lower().endswith(ext) for ext in ['.mp4', '.mov', '.m4v'])
-                new_media = InputMediaVideo(media=media_file) if is_video else InputMediaPhoto(media=media_file)
-                await context.bot.edit_message_media(chat_id=chat_id, message_id=media_message_id, media=new_media)
+            with contextlib.ExitStack() as stack:
+                media = input_media(media_path, stack)
+                new_media = InputMediaVideo(media=media) if is_video_path(media_path) else InputMediaPhoto(media=media)
+                edited = await context.bot.edit_message_media(chat_id=chat_id, message_id=media_message_id, media=new_media)
+                if isinstance(edited, Message): MEDIA_CACHE.remember([(media_path, edited)])
         except error.BadRequest as e:
             if "message is not modified" not in str(e):
-                await send_preview_message(update, context, media_type, start_index=next_index)
+                await send_preview_message(update, context, media_type, start_index=next_index, media_paths=media_paths)
         except Exception:
-            await send_preview_message(update, context, media_type, start_index=next_index)
+            await send_preview_message(update, context, media_type, start_index=next_index, media_paths=media_paths)
         return
 
     elif data.startswith("select_package:"):
@@ -806,7 +1568,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 
         if media_type == "livecall":
             await send_tracked_message(context, chat_id, text=get_text("live_call_available_text", context))
-            price = PRICES[media_type][amount]
+            price = get_package_price(media_type, amount).price
             text = get_text("live_call_selection_text", context, amount=amount, price=price, TELEGRAM_USERNAME=TELEGRAM_USERNAME)
             keyboard = [
                 [InlineKeyboardButton(f"💸 {price}€ per PayPal", callback_data=f"pay_paypal:{media_type}:{amount}")],
@@ -817,18 +1579,16 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             await send_tracked_message(context, chat_id, text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
             return
 
-        base_price = PRICES[media_type][amount]
-        package_key = f"{media_type}_{amount}"
-        price = get_discounted_price(base_price, user_data.get("discounts"), package_key)
-        if price == -1: price = base_price
+        package_price = get_package_price(media_type, amount, record.discounts)
+        base_price, price = package_price.base, package_price.price
         price_str = f"~{base_price}€~ *{price}€* ({get_text('discount_text', context)})" if price != base_price else f"*{price}€*"
         
         media_type_str = get_text(f"package_button_text_{media_type.lower()}", context, amount="").replace(str(amount), "").strip()
         text = get_text("package_selection_text", context, amount=amount, media_type=media_type_str, price_str=price_str)
 
-        if not user_data.get("paypal_offer_sent"):
+        if not record.paypal_offer_sent:
             text += get_text("paypal_offer_text", context)
-            stats["users"][str(user.id)]["paypal_offer_sent"] = True; save_stats(stats)
+            record.paypal_offer_sent = True; save_stats(stats, users=[str(user.id)])
             
         keyboard = [
             [InlineKeyboardButton(get_text("paypal_button", context), callback_data=f"pay_paypal:{media_type}:{amount}")],
@@ -840,30 +1600,22 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     async def update_payment_log(payment_method: str, price_val: int, package_info: str):
-        stats_log = load_stats(); user_data_log = stats_log.get("users", {}).get(str(user.id))
-        if user_data_log:
-            payment_info = f"{payment_method} ({package_info}): {price_val}€"
-            if payment_info not in user_data_log.get("payments_initiated", []):
-                user_data_log.setdefault("payments_initiated", []).append(payment_info); save_stats(stats_log)
-        await send_or_update_admin_log(context, user, event_text=f"Bezahlmethode '{payment_method}' für {price_val}€ gewählt")
+        stats_log = load_stats(); record_log = stats_log.get("users", {}).get(str(user.id))
+        if record_log and record_log.add_payment(payment_method, package_info, price_val): save_stats(stats_log, users=[str(user.id)])
+        log_admin_event(context, user, event_text=f"Bezahlmethode '{payment_method}' für {price_val}€ gewählt")
 
     if data.startswith(("pay_paypal:", "pay_voucher:", "pay_crypto:")):
         _, media_type, amount_str = data.split(":")
         amount = int(amount_str)
         original_message = query.message
 
+        price = get_package_price(media_type, amount, record.discounts).price
         if media_type == "livecall":
-            price = PRICES[media_type][amount]
             package_info_text = get_text("package_info_live_call", context, amount=amount)
         elif media_type == "treffen":
-            price = ceil(PRICES[media_type][amount] / 4)
             duration_text = get_package_button_text('treffen', amount, user.id, context).split(' ')[0]
             package_info_text = get_text("package_info_meeting_deposit", context, duration_text=duration_text)
         else:
-            base_price = PRICES[media_type][amount]
-            package_key = f"{media_type}_{amount}"
-            price = get_discounted_price(base_price, user_data.get("discounts"), package_key)
-            if price == -1: price = base_price
             package_info_text = f"{amount} {media_type.capitalize()}"
 
         back_button_data = "back_to_treffen_summary" if media_type == "treffen" else (f"select_package:{media_type}:{amount}" if media_type == "livecall" else "show_price_options")
@@ -878,7 +1630,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         elif data.startswith("pay_voucher:"):
             await track_event(f"payment_{media_type}", context, user.id); await update_payment_log("Gutschein", price, package_info_text)
-            context.user_data["awaiting_voucher"] = "amazon"
+            set_awaiting_input(context, "voucher", payload="amazon")
             text = get_text("voucher_prompt_text", context)
             await original_message.edit_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text("cancel_button", context), callback_data=back_button_data)]]))
         
@@ -894,13 +1646,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 
     elif data.startswith("show_wallet:"):
         _, crypto_type, media_type, amount_str = data.split(":")
-        amount = int(amount_str); price = 0
-        if media_type == "livecall": price = PRICES[media_type][amount]
-        elif media_type == "treffen": price = ceil(PRICES[media_type][amount] / 4)
-        else:
-            base_price = PRICES[media_type][amount]; package_key = f"{media_type}_{amount}"
-            price = get_discounted_price(base_price, user_data.get("discounts"), package_key)
-            price = price if price != -1 else base_price
+        amount = int(amount_str)
+        price = get_package_price(media_type, amount, record.discounts).price
         
         wallet_address = BTC_WALLET if crypto_type == "btc" else ETH_WALLET
         crypto_name = "Bitcoin (BTC)" if crypto_type == "btc" else "Ethereum (ETH)"
@@ -910,120 +1657,574 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    text_input = update.message.text
-    chat_id = update.effective_chat.id
-
-    if str(user.id) == ADMIN_USER_ID:
-        try: await context.bot.delete_message(chat_id, update.message.message_id)
-        except error.TelegramError: pass
-        
-        if context.user_data.get('awaiting_user_id_for_sperren'): await handle_admin_user_management_input(update, context, "sperren"); return
-        if context.user_data.get('awaiting_user_id_for_entsperren'): await handle_admin_user_management_input(update, context, "entsperren"); return
-        if context.user_data.get('awaiting_user_id_for_preview_limit'): await handle_admin_preview_limit_input(update, context); return
-        if context.user_data.get('awaiting_user_id_for_discount_deletion'): await handle_admin_delete_user_discount_input(update, context); return
-    
-    try: await context.bot.delete_message(chat_id, update.message.message_id)
+    try: await context.bot.delete_message(update.effective_chat.id, update.message.message_id)
     except error.TelegramError: pass
+    state = context.user_data.get('awaiting_input'); handler = TEXT_INPUT_HANDLERS.get(state)
+    if handler is None: return
+    if state.startswith("admin_") and str(update.effective_user.id) != ADMIN_USER_ID: return
+    await handler(update, context)
 
-    if context.user_data.get('awaiting_input') == 'treffen_date':
-        await cleanup_bot_messages(chat_id, context)
-        buchung = context.user_data.get('treffen_buchung', {})
-        match = re.match(r"^\s*(\d{1,2}\s*\.\s*\d{1,2})\s*\.?\s*$", text_input)
-        if match:
-            buchung['date'] = match.group(1).replace(" ", "")
-            context.user_data['treffen_buchung'] = buchung
-            context.user_data['awaiting_input'] = 'treffen_location'
-            await send_tracked_message(context, chat_id, text=get_text("meeting_location_prompt", context))
-        else:
-            await send_tracked_message(context, chat_id, text=get_text("invalid_date_prompt", context), parse_mode='Markdown')
-        return
+async def handle_treffen_date_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    await cleanup_bot_messages(chat_id, context)
+    buchung = context.user_data.get('treffen_buchung', {})
+    match = re.match(r"^\s*(\d{1,2}\s*\.\s*\d{1,2})\s*\.?\s*$", update.message.text)
+    if match:
+        buchung['date'] = match.group(1).replace(" ", "")
+        context.user_data['treffen_buchung'] = buchung
+        set_awaiting_input(context, 'treffen_location')
+        await send_tracked_message(context, chat_id, text=get_text("meeting_location_prompt", context))
+    else:
+        await send_tracked_message(context, chat_id, text=get_text("invalid_date_prompt", context), parse_mode='Markdown')
 
-    if context.user_data.get('awaiting_input') == 'treffen_location':
-        buchung = context.user_data.get('treffen_buchung', {})
-        buchung['location'] = text_input
-        context.user_data['awaiting_input'] = None
-        await show_treffen_summary(update, context)
-        return
+async def handle_treffen_location_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    buchung = context.user_data.get('treffen_buchung', {})
+    buchung['location'] = update.message.text
+    clear_awaiting_input(context.user_data)
+    await show_treffen_summary(update, context)
 
-    if context.user_data.get("awaiting_voucher"):
-        await cleanup_bot_messages(chat_id, context)
-        provider = context.user_data.pop("awaiting_voucher")
-        code = text_input
-        vouchers = load_vouchers()
-        vouchers.setdefault(provider, []).append(code)
-        save_vouchers(vouchers)
-        notification_text = (f"📬 *Neuer Gutschein erhalten!* 📬\n\n*Anbieter:* {provider.capitalize()}\n*Code:* `{code}`\n*Von Nutzer:* {escape_markdown(user.first_name, version=2)} (`{user.id}`)\n\n⚠️ *AKTION ERFORDERLICH:* Code prüfen!")
-        if NOTIFICATION_GROUP_ID: await context.bot.send_message(chat_id=NOTIFICATION_GROUP_ID, text=notification_text, parse_mode='Markdown')
-        await send_or_update_admin_log(context, user, event_text=f"Gutschein '{provider}' eingereicht")
-        user_confirmation_text = get_text("voucher_submitted_text", context)
-        keyboard = [[InlineKeyboardButton(get_text("main_menu_button", context), callback_data="main_menu")]]
-        await send_tracked_message(context, chat_id, text=user_confirmation_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        return
+async def handle_voucher_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user; chat_id = update.effective_chat.id
+    await cleanup_bot_messages(chat_id, context)
+    provider = clear_awaiting_input(context.user_data)
+    code = update.message.text
+    vouchers = load_vouchers()
+    vouchers.setdefault(provider, []).append(code)
+    save_vouchers(vouchers)
+    notification_text = (f"📬 *Neuer Gutschein erhalten!* 📬\n\n*Anbieter:* {provider.capitalize()}\n*Code:* `{code}`\n*Von Nutzer:* {escape_markdown(user.first_name, version=2)} (`{user.id}`)\n\n⚠️ *AKTION ERFORDERLICH:* Code prüfen!")
+    if NOTIFICATION_GROUP_ID: await context.bot.send_message(chat_id=NOTIFICATION_GROUP_ID, text=notification_text, parse_mode='Markdown')
+    log_admin_event(context, user, event_text=f"Gutschein '{provider}' eingereicht")
+    user_confirmation_text = get_text("voucher_submitted_text", context)
+    keyboard = [[InlineKeyboardButton(get_text("main_menu_button", context), callback_data="main_menu")]]
+    await send_tracked_message(context, chat_id, text=user_confirmation_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
 async def handle_admin_user_management_input(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str):
-    user_id_to_manage = update.message.text; context.user_data[f'awaiting_user_id_for_{action}'] = False
+    user_id_to_manage = update.message.text; clear_awaiting_input(context.user_data)
     await cleanup_bot_messages(update.effective_chat.id, context)
     if not user_id_to_manage.isdigit(): await send_tracked_message(context, update.effective_chat.id, text="⚠️ Ungültige ID."); await show_admin_menu(update, context); return
     stats = load_stats()
     if user_id_to_manage not in stats.get("users", {}): await send_tracked_message(context, update.effective_chat.id, text=f"⚠️ Nutzer mit ID `{user_id_to_manage}` nicht gefunden."); await show_admin_menu(update, context); return
-    stats["users"][user_id_to_manage]["banned"] = True if action == "sperren" else False; save_stats(stats)
+    stats["users"][user_id_to_manage].banned = action == "sperren"; save_stats(stats, users=[user_id_to_manage])
     verb = "gesperrt" if action == "sperren" else "entsperrt"; await send_tracked_message(context, update.effective_chat.id, text=f"✅ Nutzer `{user_id_to_manage}` wurde erfolgreich *{verb}*."); await show_admin_menu(update, context)
 
 async def handle_admin_preview_limit_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['awaiting_user_id_for_preview_limit'] = False; user_id_to_manage = update.message.text
+    clear_awaiting_input(context.user_data); user_id_to_manage = update.message.text
     await cleanup_bot_messages(update.effective_chat.id, context)
     if not user_id_to_manage.isdigit(): await send_tracked_message(context, update.effective_chat.id, text="⚠️ Ungültige ID."); await show_admin_menu(update, context); return
     stats = load_stats()
     if user_id_to_manage not in stats["users"]: await send_tracked_message(context, update.effective_chat.id, text=f"⚠️ Nutzer mit ID `{user_id_to_manage}` nicht gefunden."); await show_admin_menu(update, context); return
-    current_clicks = stats['users'][user_id_to_manage].get('preview_clicks', 0)
+    current_clicks = stats['users'][user_id_to_manage].preview_clicks
     text = f"Nutzer `{user_id_to_manage}` hat *{current_clicks}* Klicks.\n\nWas tun?"; keyboard = [[InlineKeyboardButton("Auf 0 setzen", callback_data=f"admin_preview_reset:{user_id_to_manage}")], [InlineKeyboardButton("Um 25 erhöhen", callback_data=f"admin_preview_increase:{user_id_to_manage}")], [InlineKeyboardButton("❌ Abbrechen", callback_data="admin_user_manage")]];
     await send_tracked_message(context, update.effective_chat.id, text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
 async def execute_manage_preview_limit(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str, action: str):
-    stats = load_stats(); user_data = stats.get("users", {}).get(user_id)
-    if not user_data: await query_or_message_edit(update, context, f"Fehler: Nutzer {user_id} nicht gefunden.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_user_manage")]])); return
-    current_clicks = user_data.get('preview_clicks', 0)
-    new_clicks = 0 if action == 'reset' else current_clicks + 25
-    stats["users"][user_id]['preview_clicks'] = new_clicks; save_stats(stats)
+    stats = load_stats(); record = stats.get("users", {}).get(user_id)
+    if not record: await query_or_message_edit(update, context, f"Fehler: Nutzer {user_id} nicht gefunden.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_user_manage")]])); return
+    new_clicks = 0 if action == 'reset' else record.preview_clicks + 25
+    record.preview_clicks = new_clicks; save_stats(stats, users=[user_id])
     text = f"✅ Vorschau-Limit für `{user_id}` ist jetzt *{new_clicks}*."
     await query_or_message_edit(update, context, text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_user_manage")]]))
 
 async def execute_delete_all_discounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    stats = load_stats(); cleared_count = 0
-    for user_id in stats["users"]:
-        if "discounts" in stats["users"][user_id]:
-            del stats["users"][user_id]["discounts"]; cleared_count += 1
-    save_stats(stats); await save_discounts_to_telegram(context)
-    text = f"✅ Alle Rabatte von *{cleared_count}* Nutzern entfernt."
+    stats = load_stats(); cleared = []
+    for user_id, record in stats["users"].items():
+        if record.discounts is not None:
+            record.discounts = None; cleared.append(user_id)
+    if cleared: save_stats(stats, users=cleared)
+    await save_discounts_to_telegram(context)
+    text = f"✅ Alle Rabatte von *{len(cleared)}* Nutzern entfernt."
     await query_or_message_edit(update, context, text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_manage_discounts")]]))
 
 async def handle_admin_delete_user_discount_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['awaiting_user_id_for_discount_deletion'] = False; user_id_to_clear = update.message.text
+    clear_awaiting_input(context.user_data); user_id_to_clear = update.message.text
     await cleanup_bot_messages(update.effective_chat.id, context)
     if not user_id_to_clear.isdigit(): await send_tracked_message(context, update.effective_chat.id, text="⚠️ Ungültige ID."); await show_admin_menu(update, context); return
-    stats = load_stats(); user_data = stats.get("users", {}).get(user_id_to_clear)
-    if not user_data or "discounts" not in user_data: await send_tracked_message(context, update.effective_chat.id, f"ℹ️ Nutzer `{user_id_to_clear}` hat keine Rabatte."); await show_admin_menu(update, context); return
+    stats = load_stats(); record = stats.get("users", {}).get(user_id_to_clear)
+    if not record or record.discounts is None: await send_tracked_message(context, update.effective_chat.id, f"ℹ️ Nutzer `{user_id_to_clear}` hat keine Rabatte."); await show_admin_menu(update, context); return
     text = f"Nutzer `{user_id_to_clear}` hat Rabatte. Löschen?"; keyboard = [[InlineKeyboardButton("✅ Ja, löschen", callback_data=f"admin_delete_user_discount_execute:{user_id_to_clear}")], [InlineKeyboardButton("❌ Abbrechen", callback_data="admin_manage_discounts")]];
     await send_tracked_message(context, update.effective_chat.id, text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def execute_delete_user_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id_to_clear: str):
     stats = load_stats()
-    if user_id_to_clear in stats["users"] and "discounts" in stats["users"][user_id_to_clear]:
-        del stats["users"][user_id_to_clear]["discounts"]; save_stats(stats); await save_discounts_to_telegram(context)
+    if user_id_to_clear in stats["users"] and stats["users"][user_id_to_clear].discounts is not None:
+        stats["users"][user_id_to_clear].discounts = None; save_stats(stats, users=[user_id_to_clear]); await save_discounts_to_telegram(context)
         text = f"✅ Rabatte für `{user_id_to_clear}` entfernt."
         await query_or_message_edit(update, context, text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_manage_discounts")]]))
     else: await query_or_message_edit(update, context, f"ℹ️ Fehler: Nutzer `{user_id_to_clear}` hat keine Rabatte.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_manage_discounts")]]))
 
-async def post_init(application: Application):
-    await load_discounts_from_telegram(application)
+# Text input is routed by the pending state; admin_* states are only accepted from the admin
+TEXT_INPUT_HANDLERS = {
+    "treffen_date": handle_treffen_date_input,
+    "treffen_location": handle_treffen_location_input,
+    "voucher": handle_voucher_input,
+    "admin_sperren": lambda update, context: handle_admin_user_management_input(update, context, "sperren"),
+    "admin_entsperren": lambda update, context: handle_admin_user_management_input(update, context, "entsperren"),
+    "admin_preview_limit": handle_admin_preview_limit_input,
+    "admin_discount_deletion": handle_admin_delete_user_discount_input,
+}
 
-def main() -> None:
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+# --- Stats Maintenance ---
+ARCHIVE_USER_ID_PATTERN = re.compile(rb'^\{"user_id": "([^"]+)"')  # Entries are written with user_id first
+
+class StatsArchive:
+    """Cold store for archived users (STATS_ARCHIVE_FILE); only the offset of each user's latest entry is kept in memory.
+
+    The index is built once, in a worker thread at startup (post_init). Entries of restored users stay in the
+    file until the stats maintenance rewrites it with compact().
+    """
+
+    def __init__(self):
+        self.path = None; self.offsets = {}
+
+    def load(self) -> dict:
+        if self.path != STATS_ARCHIVE_FILE:
+            self.path = STATS_ARCHIVE_FILE; self.offsets = self.read_index(STATS_ARCHIVE_FILE)
+        return self.offsets
+
+    @staticmethod
+    def read_index(path: str) -> dict:
+        offsets = {}
+        try:
+            with open(path, "rb") as f:
+                offset = 0
+                for line in f:
+                    match = ARCHIVE_USER_ID_PATTERN.match(line)
+                    try: offsets[match.group(1).decode() if match else json.loads(line)["user_id"]] = offset
+                    except (ValueError, KeyError): logger.warning(f"Skipping unreadable entry at byte {offset} of {path}.")
+                    offset += len(line)
+        except FileNotFoundError: pass
+        return offsets
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.load()
+
+    def append(self, entries: list):
+        offsets = self.load()
+        with open(STATS_ARCHIVE_FILE, "ab") as f:
+            for entry in entries:
+                offsets[entry["user_id"]] = f.tell(); f.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    def restore(self, user_id: str) -> UserRecord | None:
+        """The user's latest archived record; the entry stays in the file, but is not restored twice."""
+        offset = self.load().pop(user_id, None)
+        if offset is None: return None
+        try:
+            with open(STATS_ARCHIVE_FILE, "rb") as f: f.seek(offset); entry = json.loads(f.readline())
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not restore archived user {user_id}: {e}"); return None
+        logger.info(f"Restored archived user {user_id} (archived {datetime.fromtimestamp(entry['archived_at']).isoformat()}).")
+        return UserRecord.from_json(entry["record"])
+
+    @staticmethod
+    def rewrite(path: str, offsets: dict) -> dict:
+        """Copies the entries at offsets into path + ".tmp" and returns their new offsets."""
+        new_offsets = {}
+        with open(path, "rb") as src, open(f"{path}.tmp", "wb") as dst:
+            for user_id, offset in sorted(offsets.items(), key=lambda item: item[1]):
+                src.seek(offset); new_offsets[user_id] = dst.tell(); dst.write(src.readline())
+            dst.flush(); os.fsync(dst.fileno())
+        return new_offsets
+
+    async def compact(self) -> int:
+        """Drops entries of restored users and older entries of users archived again; returns how many bytes it saved."""
+        path = STATS_ARCHIVE_FILE; size_before = file_size(path); offsets = dict(self.load())
+        if not size_before: return 0
+        new_offsets = await asyncio.to_thread(self.rewrite, path, offsets)
+        if file_size(path) != size_before or self.path != path:
+            os.remove(f"{path}.tmp"); return 0  # Appended to meanwhile; the next maintenance tries again
+        replace_synced(f"{path}.tmp", path)
+        # Users restored while the copy was written stay out of the index
+        self.offsets = {user_id: offset for user_id, offset in new_offsets.items() if user_id in self.offsets}
+        return size_before - file_size(path)
+
+STATS_ARCHIVE = StatsArchive()
+
+async def compact_stats(stats: dict, now: int) -> dict:
+    """Archives inactive users to the cold store, drops orphaned admin logs and trims idle payment histories.
+
+    Archived users are restored by ensure_user_in_stats when they come back. The ids of changed users and
+    admin logs are returned so the caller can journal them.
+    """
+    archive_cutoff = now - RETENTION_INACTIVE_DAYS * 86400; trim_cutoff = now - RETENTION_TRIM_DAYS * 86400
+    users = stats.setdefault("users", {}); admin_logs = stats.setdefault("admin_logs", {})
+    # Banned users stay hot so the ban still applies if they come back
+    inactive = [user_id for user_id, record in users.items() if record.last_start < archive_cutoff and not record.banned]
+    if inactive:
+        entries = [{"user_id": user_id, "archived_at": now, "record": users[user_id].to_json(), "admin_log": admin_logs.get(user_id)} for user_id in inactive]
+        await asyncio.to_thread(STATS_ARCHIVE.append, entries)  # Users only leave memory once their archive entry is written
+        returned = [user_id for user_id in inactive if user_id in users and users[user_id].last_start >= archive_cutoff]
+        for user_id in returned: STATS_ARCHIVE.offsets.pop(user_id, None)  # Came back during the write, they stay hot
+        inactive = [user_id for user_id in inactive if user_id in users and user_id not in returned]
+        for user_id in inactive: del users[user_id]
+    orphaned_logs = [user_id for user_id in admin_logs if user_id not in users]
+    for user_id in orphaned_logs: del admin_logs[user_id]; ADMIN_LOG_RENDERS.pop(user_id, None)
+    trimmed = []
+    for user_id, record in users.items():
+        if record.last_start < trim_cutoff and len(record.payments) > RETENTION_TRIMMED_PAYMENTS:
+            del record.payments[:-RETENTION_TRIMMED_PAYMENTS]; trimmed.append(user_id)
+    return {"archived": len(inactive), "logs_removed": len(orphaned_logs), "histories_trimmed": len(trimmed),
+            "changed_users": inactive + trimmed, "changed_logs": orphaned_logs}
+
+def file_size(path: str) -> int:
+    try: return os.path.getsize(path)
+    except OSError: return 0
+
+def measure_load_ms(path: str) -> float | None:
+    """How long a plain parse of path takes; unlike read_stats_file, never touches a damaged file."""
+    started = time.perf_counter()
+    try:
+        with open(path, "r") as f: json.load(f)
+    except (OSError, ValueError): return None
+    return (time.perf_counter() - started) * 1000
+
+async def run_stats_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    size_before = file_size(STATS_FILE); t = time.perf_counter()
+    try:
+        # Only the compaction itself runs on the loop; it is journaled, then written out by a background checkpoint
+        stats = load_stats(); result = await compact_stats(stats, int(time.time()))
+        changed_users, changed_logs = result.pop("changed_users"), result.pop("changed_logs")
+        if changed_users or changed_logs: save_stats(stats, users=changed_users, admin_logs=changed_logs)
+        await STATS_STORE.checkpoint_in_background()
+        result["archive_bytes_freed"] = await STATS_ARCHIVE.compact()
+    except Exception as e:
+        logger.error(f"Stats maintenance failed: {e}"); return
+    size_after = file_size(STATS_FILE); load_ms = await asyncio.to_thread(measure_load_ms, STATS_FILE)
+    load_text = f"{load_ms:.1f} ms" if load_ms is not None else "n/a"
+    report = (f"🧹 *Wartung abgeschlossen* ({time.perf_counter() - t:.1f}s)\n\n"
+              f"Archiviert: {result['archived']} Nutzer\nEntfernte Logs: {result['logs_removed']}\nGekürzte Verläufe: {result['histories_trimmed']}\n"
+              f"Größe: {size_before / 1024:.1f} KB → {size_after / 1024:.1f} KB\nArchiv verkleinert um: {result['archive_bytes_freed'] / 1024:.1f} KB\nLadezeit: {load_text}")
+    logger.info(f"Stats maintenance: {result}, size {size_before} -> {size_after} bytes, load {load_text}")
+    if NOTIFICATION_GROUP_ID:
+        try: await context.bot.send_message(chat_id=NOTIFICATION_GROUP_ID, text=report, parse_mode='Markdown')
+        except error.TelegramError as e: logger.warning(f"Could not post maintenance report: {e}")
+
+# --- Media Pre-Upload ---
+def all_media_files() -> list:
+    return sorted({path for media_type in ("bilder", "videos") for purpose in ("vorschau", "preis") for path in get_media_files(media_type, purpose)})
+
+async def upload_media_file(bot, chat_id, media_path: str) -> Message:
+    """Uploads one file to the cache chat and deletes the message again; the file_id stays valid."""
+    with open(media_path, 'rb') as media_file:
+        # Lowest priority, so a pre-upload never delays replies to users
+        if is_video_path(media_path): message = await bot.send_video(chat_id=chat_id, video=media_file, disable_notification=True, supports_streaming=True, rate_limit_args=PRIORITY_CLEANUP)
+        else: message = await bot.send_photo(chat_id=chat_id, photo=media_file, disable_notification=True, rate_limit_args=PRIORITY_CLEANUP)
+    try: await bot.delete_message(chat_id=chat_id, message_id=message.message_id, rate_limit_args=PRIORITY_CLEANUP)
+    except error.TelegramError: pass
+    return message
+
+async def preupload_media(bot, chat_id, is_running=lambda: True) -> dict:
+    """Uploads every media file without a valid cached file_id, PREUPLOAD_CONCURRENCY at a time."""
+    paths = all_media_files(); pending = [path for path in paths if not MEDIA_CACHE.get(path)]
+    result = {"total": len(paths), "cached": len(paths) - len(pending), "uploaded": 0, "failed": [], "retries": 0}
+    semaphore = asyncio.Semaphore(PREUPLOAD_CONCURRENCY); uploaded = []; progress_step = max(1, len(pending) // 10)
+
+    async def upload(media_path: str):
+        async with semaphore:
+            if not is_running(): return  # Shutting down; the rest is uploaded on the next start
+            for attempt in range(1, PREUPLOAD_MAX_ATTEMPTS + 1):
+                try:
+                    message = await upload_media_file(bot, chat_id, media_path); break
+                except (error.BadRequest, OSError) as e:  # Retrying would fail the same way
+                    result["failed"].append(media_path); logger.warning(f"Pre-upload of {media_path} failed: {e}"); return
+                except error.TelegramError as e:
+                    if attempt == PREUPLOAD_MAX_ATTEMPTS:
+                        result["failed"].append(media_path); logger.warning(f"Pre-upload of {media_path} failed after {attempt} attempts: {e}"); return
+                    result["retries"] += 1; logger.info(f"Pre-upload of {media_path} failed ({e}), retry {attempt}/{PREUPLOAD_MAX_ATTEMPTS - 1}")
+                    await asyncio.sleep(2 ** attempt)
+            uploaded.append((media_path, message)); result["uploaded"] += 1
+            if len(uploaded) >= 20: MEDIA_CACHE.remember(uploaded); uploaded.clear()
+            if result["uploaded"] % progress_step == 0: logger.info(f"Media pre-upload: {result['uploaded']}/{len(pending)} uploaded")
+
+    await asyncio.gather(*(upload(path) for path in pending))
+    MEDIA_CACHE.remember(uploaded)
+    return result
+
+async def preupload_media_job(context: ContextTypes.DEFAULT_TYPE):
+    chat_id = MEDIA_CACHE_CHAT_ID or NOTIFICATION_GROUP_ID or ADMIN_USER_ID
+    if not chat_id: return
+    t = time.perf_counter(); result = await preupload_media(context.bot, chat_id, lambda: context.application.running); elapsed = time.perf_counter() - t
+    logger.info(f"Media pre-upload finished in {elapsed:.1f}s: {result['uploaded']} uploaded, {result['cached']} already cached, {len(result['failed'])} failed, {result['retries']} retries")
+    if NOTIFICATION_GROUP_ID and (result["uploaded"] or result["failed"]):
+        failed = "".join(f"\n   • `{os.path.basename(path)}`" for path in result["failed"][:10])
+        report = (f"📤 *Medien-Vorupload abgeschlossen* ({elapsed:.1f}s)\n\n"
+                  f"Hochgeladen: {result['uploaded']}\nBereits im Cache: {result['cached']}\nWiederholungen: {result['retries']}\nFehlgeschlagen: {len(result['failed'])}{failed}")
+        try: await context.bot.send_message(chat_id=NOTIFICATION_GROUP_ID, text=report, parse_mode='Markdown')
+        except error.TelegramError as e: logger.warning(f"Could not post pre-upload report: {e}")
+
+# --- Profiling ---
+# Only active with PROFILE_HANDLERS set; otherwise nothing is wrapped and normal traffic pays nothing.
+_active_route = contextvars.ContextVar("active_route", default=None)
+
+class HandlerProfiler:
+    """Per-route timing breakdown plus a stack sampler for a fraction of updates.
+
+    Writes ``routes.json`` (timings per route and category) and ``stacks.folded`` (collapsed stacks,
+    ready for flamegraph.pl or speedscope) to PROFILE_DIR.
+    """
+    CATEGORIES = ("stats_io", "bot_api", "pdf")
+
+    def __init__(self, sample_rate: float, output_dir: str, sample_interval: float = 0.005, flush_every: int = 50):
+        self.sample_rate = sample_rate; self.output_dir = output_dir
+        self.sample_interval = sample_interval; self.flush_every = flush_every
+        self.routes = {}; self.stacks = Counter(); self.updates = 0
+        self.sampled = None; self.loop_thread_id = None; self._sampler = None  # sampled: (route, frame of the sampled handler)
+
+    def timed(self, category: str, func):
+        def record(started: float):
+            timings = _active_route.get(); timings.pop("_timing")
+            timings[category] = timings.get(category, 0.0) + time.perf_counter() - started
+        def untimed() -> bool:  # Outside a profiled route, or nested inside another timed call (save_stats -> load_stats)
+            timings = _active_route.get()
+            if timings is None or "_timing" in timings: return True
+            timings["_timing"] = category; return False
+        if asyncio.iscoroutinefunction(func):
+            async def async_wrapper(*args, **kwargs):
+                if untimed(): return await func(*args, **kwargs)
+                started = time.perf_counter()
+                try: return await func(*args, **kwargs)
+                finally: record(started)
+            return async_wrapper
+        def wrapper(*args, **kwargs):
+            if untimed(): return func(*args, **kwargs)
+            started = time.perf_counter()
+            try: return func(*args, **kwargs)
+            finally: record(started)
+        return wrapper
+
+    def handler(self, func, route_for):
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if _active_route.get() is not None: return await func(update, context)  # Nested call, e.g. start() from a callback
+            route = route_for(update, context); timings = {}; token = _active_route.set(timings)
+            sampled = self.sampled is None and random.random() < self.sample_rate
+            if sampled: self._start_sampling(route, sys._getframe())
+            started = time.perf_counter()
+            try: return await func(update, context)
+            finally:
+                total = time.perf_counter() - started
+                if sampled: self.sampled = None
+                _active_route.reset(token); self._record(route, total, timings, sampled)
+        return wrapper
+
+    def _record(self, route: str, total: float, timings: dict, sampled: bool):
+        entry = self.routes.setdefault(route, {"count": 0, "sampled": 0, "total": 0.0, "max": 0.0, **{c: 0.0 for c in self.CATEGORIES}, "rendering": 0.0})
+        entry["count"] += 1; entry["sampled"] += sampled; entry["total"] += total; entry["max"] = max(entry["max"], total)
+        for category in self.CATEGORIES: entry[category] += timings.get(category, 0.0)
+        entry["rendering"] += max(0.0, total - sum(timings.values()))
+        self.updates += 1
+        if self.updates % self.flush_every == 0: self.flush()
+
+    def _start_sampling(self, route: str, frame):
+        self.loop_thread_id = threading.get_ident(); self.sampled = (route, frame)
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample_loop, name="handler-profiler", daemon=True); self._sampler.start()
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.sample_interval)
+            sampled = self.sampled
+            if sampled is None: continue
+            route, handler_frame = sampled
+            frame = sys._current_frames().get(self.loop_thread_id); stack = []; in_handler = False
+            while frame is not None:
+                in_handler = in_handler or frame is handler_frame
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"); frame = frame.f_back
+            # While the handler awaits, the loop runs the selector or other tasks; those samples are not the route's
+            if in_handler: self.stacks[";".join([route] + stack[::-1])] += 1
+
+    def flush(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        summary = {}
+        for route, entry in self.routes.items():
+            count = entry["count"]
+            summary[route] = {"count": count, "sampled": entry["sampled"], "avg_ms": entry["total"] / count * 1000, "max_ms": entry["max"] * 1000,
+                              **{f"{c}_ms": entry[c] / count * 1000 for c in (*self.CATEGORIES, "rendering")}}
+        write_json_atomic(os.path.join(self.output_dir, "routes.json"), summary, indent=2)
+        with open(os.path.join(self.output_dir, "stacks.folded"), "w") as f:
+            for stack, count in self.stacks.copy().items(): f.write(f"{stack} {count}\n")
+
+def callback_route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    return "callback:" + (update.callback_query.data or "").split(":")[0]
+
+def text_route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    return "text:" + (context.user_data.get('awaiting_input') or "message")
+
+PROFILER = HandlerProfiler(PROFILE_SAMPLE_RATE, PROFILE_DIR) if PROFILE_HANDLERS else None
+if PROFILER:
+    load_stats = PROFILER.timed("stats_io", load_stats)
+    save_stats = PROFILER.timed("stats_io", save_stats)
+    build_vouchers_pdf = PROFILER.timed("pdf", build_vouchers_pdf)
+    PriorityRateLimiter.process_request = PROFILER.timed("bot_api", PriorityRateLimiter.process_request)
+    start = PROFILER.handler(start, lambda update, context: "start")
+    handle_callback_query = PROFILER.handler(handle_callback_query, callback_route)
+    handle_text_message = PROFILER.handler(handle_text_message, text_route)
+
+# --- Event Loop Watchdog ---
+def describe_update(update) -> str:
+    if update.callback_query: return "callback:" + (update.callback_query.data or "").split(":")[0]
+    if update.message and update.message.text:
+        return "command:" + update.message.text.split()[0] if update.message.text.startswith("/") else "text"
+    return "update"
+
+class LoopLagMonitor:
+    """Heartbeat task on the event loop plus a watchdog thread.
+
+    When the heartbeat is late by more than the threshold, the watchdog captures the loop thread's stack while it is
+    still blocked, and the update being handled (found in the stack's frames). Stalls are counted per location.
+    """
+
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD, interval: float = LOOP_LAG_INTERVAL, alert_interval: float = LOOP_LAG_ALERT_INTERVAL):
+        self.threshold = threshold; self.interval = interval; self.alert_interval = alert_interval
+        self.stalls = 0; self.max_lag = 0.0; self.locations = Counter(); self.update_types = Counter()
+        self.last_alert = {}; self.suppressed = Counter()
+        self.beat = time.monotonic(); self.captured = None; self.loop_thread_id = None; self.task = None; self.stopped = threading.Event()
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident(); self.stopped.clear(); self.beat = time.monotonic()
+        self.task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task: self.task.cancel(); self.task = None
+
+    async def _heartbeat(self):
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self.beat - self.interval
+            if lag >= self.threshold: self._record(lag)
+            else: self.captured = None
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            if self.captured is None and time.monotonic() - self.beat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None: self.captured = self._capture(frame)
+
+    @staticmethod
+    def _capture(frame) -> tuple:
+        stack = []; update_type = None
+        while frame is not None:
+            stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}")
+            if update_type is None and isinstance(frame.f_locals.get("update"), Update): update_type = describe_update(frame.f_locals["update"])
+            frame = frame.f_back
+        return update_type or "no update", stack  # Innermost frame first
+
+    def _record(self, lag: float):
+        update_type, stack = self.captured or ("unknown", []); self.captured = None
+        # The innermost frame of our own code names the culprit better than the library call it is stuck in
+        location = next((entry for entry in stack if entry.startswith("bot.py:")), stack[0] if stack else "unknown")
+        self.stalls += 1; self.max_lag = max(self.max_lag, lag); self.locations[location] += 1; self.update_types[update_type] += 1
+        now = time.monotonic()
+        if now - self.last_alert.get(location, -self.alert_interval) < self.alert_interval: self.suppressed[location] += 1; return
+        self.last_alert[location] = now; suppressed = self.suppressed.pop(location, 0)
+        logger.warning(f"Event loop blocked for {lag * 1000:.0f} ms in {location} while handling {update_type}"
+                       f"{f' ({suppressed} similar stalls not logged)' if suppressed else ''}. Stack (innermost first): {' <- '.join(stack[:12])}")
+
+    def summary_lines(self, top: int = 3) -> list:
+        lines = [f"⏱️ Event-Loop blockiert (> {self.threshold * 1000:.0f} ms): {self.stalls}x, max {self.max_lag * 1000:.0f} ms"]
+        lines += [f"   • `{location}`: {count}x" for location, count in self.locations.most_common(top)]
+        return lines
+
+LOOP_MONITOR = LoopLagMonitor()
+
+# --- Update Recording ---
+TRAFFIC_FORMAT = "bot-traffic-v1"
+LONG_NUMBER_PATTERN = re.compile(r"\d{5,}")  # User and chat ids; package amounts and dates are shorter
+LETTER_PATTERN = re.compile(r"[^\W\d_]")
+ALPHANUMERIC_PATTERN = re.compile(r"[^\W_]")
+SECRET_INPUT_STATES = ("voucher",)  # Text sent in these states is a secret as a whole; only its shape is recorded
+
+class UpdateRecorder:
+    """Appends anonymized updates to a gzip JSONL file: a header line, then one {"t", "update"} line per update.
+
+    Ids are replaced by keyed hashes that are stable within one recording, names are dropped and letters in
+    free text are masked. Commands, callback data and digits (dates, amounts) survive, so a replay takes the
+    same paths through the handlers. Text sent in a SECRET_INPUT_STATES state (voucher codes) keeps no
+    digits either.
+    """
+
+    def __init__(self, path: str):
+        self.key = os.urandom(16); self.started = time.monotonic(); self.count = 0
+        # Pseudonyms are only stable within one recording, so a restart never appends to an earlier one
+        self.path = self.session_path(path); self.f = gzip.open(self.path, "xt", encoding="utf-8")
+        logger.info(f"Recording updates to {self.path}")
+        header = {"format": TRAFFIC_FORMAT, "recorded_at": datetime.now().isoformat(timespec="seconds"),
+                  "admin_id": self.pseudonym(ADMIN_USER_ID) if ADMIN_USER_ID else None, "group_id": self.pseudonym(NOTIFICATION_GROUP_ID) if NOTIFICATION_GROUP_ID else None}
+        self.f.write(json.dumps(header) + "\n")
+
+    @staticmethod
+    def session_path(path: str) -> str:
+        if not os.path.exists(path): return path
+        stem, ext = (path[:-len(".jsonl.gz")], ".jsonl.gz") if path.endswith(".jsonl.gz") else os.path.splitext(path)
+        return f"{stem}-{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}"
+
+    def pseudonym(self, value) -> int:
+        value = int(value); digest = hashlib.blake2b(str(abs(value)).encode(), key=self.key, digest_size=5).digest()
+        pseudonym = 10**6 + int.from_bytes(digest, "big") % 10**12
+        return -pseudonym if value < 0 else pseudonym  # Keep groups recognisable as groups
+
+    def scrub_text(self, text: str) -> str:
+        command, _, rest = text.partition(" ") if text.startswith("/") else ("", "", text)
+        rest = LETTER_PATTERN.sub("x", LONG_NUMBER_PATTERN.sub(lambda m: str(self.pseudonym(m.group())), rest))
+        return f"{command} {rest}".strip() if command else rest
+
+    def anonymize(self, value, key: str | None = None):
+        if isinstance(value, dict):
+            return {k: self.anonymize(v, k) for k, v in value.items() if k not in ("last_name", "username", "phone_number", "bio")}
+        if isinstance(value, list): return [self.anonymize(item) for item in value]
+        if key in ("id", "user_id", "chat_id") and isinstance(value, int): return self.pseudonym(value)
+        if key == "first_name": return "User"
+        if key == "title": return "Chat"
+        if key in ("text", "caption") and isinstance(value, str): return self.scrub_text(value)
+        if key == "data" and isinstance(value, str): return LONG_NUMBER_PATTERN.sub(lambda m: str(self.pseudonym(m.group())), value)
+        return value
+
+    async def record(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        data = self.anonymize(update.to_dict())
+        if (context.user_data or {}).get('awaiting_input') in SECRET_INPUT_STATES and update.message and update.message.text:
+            data["message"]["text"] = ALPHANUMERIC_PATTERN.sub("x", update.message.text)  # e.g. "AQ7B-9XK2" -> "xxxx-xxxx"
+        self.f.write(json.dumps({"t": round(time.monotonic() - self.started, 3), "update": data}, ensure_ascii=False) + "\n")
+        self.count += 1
+        if self.count % 50 == 0: self.f.flush()
+
+    def close(self):
+        self.f.close(); logger.info(f"Recorded {self.count} updates.")
+
+UPDATE_RECORDER = UpdateRecorder(RECORD_UPDATES) if RECORD_UPDATES else None
+
+async def post_init(application: Application):
+    LOOP_MONITOR.start()
+    load_text_catalog()
+    load_stats()  # Recover the last checkpoint plus journal before the first update arrives
+    await asyncio.to_thread(STATS_ARCHIVE.load)  # Index the archived users off the loop, before the first /start needs it
+    application.job_queue.run_repeating(checkpoint_stats_job, interval=CHECKPOINT_INTERVAL, first=CHECKPOINT_INTERVAL, name="checkpoint_stats")
+    # Restore discounts in the background so the bot starts taking updates right away
+    application.job_queue.run_once(restore_discounts_job, when=0, name="restore_discounts")
+    application.job_queue.run_repeating(run_stats_maintenance, interval=MAINTENANCE_INTERVAL, first=timedelta(minutes=5), name="stats_maintenance")
+    application.job_queue.run_once(preupload_media_job, when=0, name="preupload_media")
+    application.job_queue.run_repeating(expire_conversation_states_job, interval=CONVERSATION_STATE_TICK, first=CONVERSATION_STATE_TICK, name="expire_conversation_states")
+    application.job_queue.run_repeating(reload_text_catalog_job, interval=TEXT_RELOAD_INTERVAL, first=TEXT_RELOAD_INTERVAL, name="reload_texts")
+
+async def post_shutdown(application: Application):
+    LOOP_MONITOR.stop()
+    STATS_STORE.close()
+    if PROFILER: PROFILER.flush()
+    if UPDATE_RECORDER: UPDATE_RECORDER.close()
+
+def build_application(token: str = BOT_TOKEN, request=None, rate_limiter: BaseRateLimiter | None = None) -> Application:
+    builder = Application.builder().token(token).rate_limiter(rate_limiter or PriorityRateLimiter()).post_init(post_init).post_shutdown(post_shutdown)
+    if request: builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+    if UPDATE_RECORDER: application.add_handler(TypeHandler(Update, UPDATE_RECORDER.record), group=-1)  # Runs before, never instead of, the handlers below
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin))
     application.add_handler(CallbackQueryHandler(handle_callback_query))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    return application
+
+def main() -> None:
+    application = build_application()
 
     if WEBHOOK_URL:
         port = int(os.environ.get("PORT", 8443))
@@ -1034,4 +2235,5 @@ def main() -> None:
         application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["compile-texts"]: print(f"Compiled {compile_text_catalog()} texts into {TEXT_CATALOG_FILE}")  # Build step
+    else: main()
@@ -0,0 +1,141 @@
+"""Replays recorded traffic against the bot's handlers with a fake Bot API.
+
+Record on the live bot with RECORD_UPDATES=traffic.jsonl.gz, then replay offline:
+
+    python replay.py traffic.jsonl.gz --speed 10
+    python replay.py traffic.jsonl.gz --speed max --save-responses before.jsonl.gz
+    python replay.py traffic.jsonl.gz --speed max --diff before.jsonl.gz   # after a change
+
+Updates are processed one at a time in recorded order, so every Bot API call is attributed to the
+update that caused it. Responses are compared without volatile fields like message and file ids.
+"""
+import argparse
+import asyncio
+import difflib
+import gzip
+import json
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import time
+from collections import Counter
+
+from telegram import Update
+
+import bot
+from benchmark import FAKE_TOKEN, FakeTelegramRequest, use_temp_data_files
+
+VOLATILE_FIELDS = {"message_id", "callback_query_id", "media", "photo", "video", "document", "date"}
+TIMESTAMP_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2})?)?")
+
+
+def read_traffic(path: str) -> tuple:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(next(f))
+        if header.get("format") != bot.TRAFFIC_FORMAT: raise SystemExit(f"{path} is not a {bot.TRAFFIC_FORMAT} recording")
+        records = [json.loads(line) for line in f if line.strip()]
+    # Older bots appended every start to the same file; each session has its own pseudonyms and clock, so only the first is replayed
+    for i, record in enumerate(records):
+        if "update" not in record:
+            print(f"{path} holds several recordings, replaying the first ({i} of {len(records)} lines)")
+            return header, records[:i]
+    return header, records
+
+
+def normalize_call(endpoint: str, params: dict) -> dict:
+    """The parts of a Bot API call that describe behaviour, not the ids of this particular run."""
+    call = {"endpoint": endpoint}
+    for key, value in sorted(params.items()):
+        if key in VOLATILE_FIELDS: continue
+        if isinstance(value, str): value = TIMESTAMP_PATTERN.sub("<time>", value)  # e.g. "Erster Start" in admin logs
+        call[key] = value if isinstance(value, (str, int, float, bool, type(None))) else json.loads(json.dumps(value, default=str))
+    return call
+
+
+async def replay(args, header: dict, records: list) -> tuple:
+    request = FakeTelegramRequest(latency=args.latency)
+    # Telegram's limits, scaled to the replay speed; at max speed they are effectively off
+    scale = 1e6 if args.speed == "max" else float(args.speed)
+    limiter = bot.PriorityRateLimiter(overall_rate=bot.OVERALL_RATE_PER_SECOND * scale, chat_rate=bot.CHAT_RATE_PER_SECOND * scale, chat_burst=bot.CHAT_BURST,
+                                      group_rate=bot.GROUP_RATE_PER_SECOND * scale, group_burst=bot.GROUP_BURST)
+    application = bot.build_application(FAKE_TOKEN, request=request, rate_limiter=limiter)
+    errors = Counter()
+
+    async def count_error(update, context): errors[type(context.error).__name__] += 1
+    application.add_error_handler(count_error)
+    await application.initialize(); await application.start()
+    latencies = []; responses = []
+    t0 = time.perf_counter()
+    for record in records:
+        if args.speed != "max":
+            delay = record["t"] / float(args.speed) - (time.perf_counter() - t0)
+            if delay > 0: await asyncio.sleep(delay)
+        update = Update.de_json(record["update"], application.bot); first_call = len(request.calls)
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - started)
+        responses.append([normalize_call(endpoint, params) for endpoint, params in request.calls[first_call:]])
+    wall = time.perf_counter() - t0
+    await application.stop(); await application.shutdown(); bot.STATS_STORE.close()
+    latencies.sort()
+    quantile = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    summary = {"updates": len(records), "wall_seconds": wall, "updates_per_second": len(records) / wall if wall else 0.0,
+               "latency_ms": {"p50": statistics.median(latencies) * 1000, "p95": quantile(0.95), "p99": quantile(0.99), "max": latencies[-1] * 1000},
+               "api_calls": dict(Counter(endpoint for endpoint, _ in request.calls).most_common()), "handler_errors": dict(errors)}
+    return summary, responses
+
+
+def diff_responses(responses: list, baseline: list, limit: int, records: list) -> int:
+    changed = [i for i in range(max(len(responses), len(baseline))) if i >= len(responses) or i >= len(baseline) or responses[i] != baseline[i]]
+    print(f"\nResponse diff: {len(changed)} of {len(responses)} updates answered differently")
+    for i in changed[:limit]:
+        update = records[i]["update"] if i < len(records) else {}
+        trigger = update.get("callback_query", {}).get("data") or update.get("message", {}).get("text", "")
+        print(f"\n--- update #{i} ({trigger!r})")
+        before = json.dumps(baseline[i] if i < len(baseline) else [], indent=1, ensure_ascii=False).splitlines()
+        after = json.dumps(responses[i] if i < len(responses) else [], indent=1, ensure_ascii=False).splitlines()
+        print("\n".join(difflib.unified_diff(before, after, "baseline", "replay", lineterm="", n=1)))
+    return len(changed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("traffic", help="recording made with RECORD_UPDATES")
+    parser.add_argument("--speed", default="max", choices=["1", "10", "max"], help="replay speed relative to the recording")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Bot API round-trip in seconds")
+    parser.add_argument("--stats", help="stats.json snapshot to start from (copied, never modified)")
+    parser.add_argument("--save-responses", help="write the normalized Bot API calls per update to this file")
+    parser.add_argument("--diff", help="compare the Bot API calls per update against a file from --save-responses")
+    parser.add_argument("--show", type=int, default=10, help="number of differing updates to print")
+    parser.add_argument("--report", help="write the summary as JSON to this file")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the bot's random choices, e.g. preview order")
+    args = parser.parse_args()
+
+    header, records = read_traffic(args.traffic)
+    bot.ADMIN_USER_ID = str(header["admin_id"]) if header.get("admin_id") else None
+    bot.NOTIFICATION_GROUP_ID = str(header["group_id"]) if header.get("group_id") else None
+    print(f"Replaying {len(records)} updates recorded {header['recorded_at']} at speed {args.speed}")
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_data_files(tmp)
+        if args.stats: shutil.copy(args.stats, bot.STATS_FILE)
+        summary, responses = asyncio.run(replay(args, header, records))
+
+    print(f"{summary['updates']} updates in {summary['wall_seconds']:.2f}s: {summary['updates_per_second']:.1f} updates/s")
+    print("latency " + "   ".join(f"{name} {value:.2f} ms" for name, value in summary["latency_ms"].items()))
+    print("api calls " + ", ".join(f"{endpoint} {count}" for endpoint, count in summary["api_calls"].items()))
+    if summary["handler_errors"]: print("handler errors " + ", ".join(f"{name} {count}" for name, count in summary["handler_errors"].items()))
+    if args.save_responses:
+        with gzip.open(args.save_responses, "wt", encoding="utf-8") as f:
+            for calls in responses: f.write(json.dumps(calls, ensure_ascii=False) + "\n")
+    if args.diff:
+        with gzip.open(args.diff, "rt", encoding="utf-8") as f: baseline = [json.loads(line) for line in f]
+        summary["changed_updates"] = diff_responses(responses, baseline, args.show, records)
+    if args.report:
+        with open(args.report, "w") as f: json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()